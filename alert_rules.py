@@ -0,0 +1,189 @@
+# alert_rules.py
+import json
+import logging
+import operator
+import os
+import numpy as np
+from pymongo import ASCENDING, DESCENDING
+
+from latest_state import LATEST_COLLECTION
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# --- Rule Table ---
+# Threshold rules in priority order: a reading's status_code is the code of the first
+# rule it matches ("OK" if none), and its alert set is every rule it matches.
+# Override with ALERT_RULES, a JSON list of objects with the same keys.
+DEFAULT_ALERT_RULES = [
+    {"code": "LOW_BATT", "field": "battery_vol", "op": "<", "threshold": 3500,
+     "label": "Low Battery", "invalid_label": "Invalid Battery Data"},
+    {"code": "NO_SIGNAL", "field": "network", "op": "<", "threshold": 10,
+     "label": "No/Low Signal", "invalid_label": "Invalid Network Data"},
+]
+
+# Alert state transitions (e.g. OK -> LOW_BATT), one document per change per meter
+ALERTS_COLLECTION = "alerts"
+
+# Status codes set by the parser itself (malformed messages); each also raises an alert
+DATA_ISSUE_STATUS_CODES = ("FORMAT_WARN", "DATA_ERR")
+
+# Reading fields a rule can test: the numbers parsed from every message (sms_parser.py)
+RULE_FIELDS = ("battery_vol", "network", "WH")
+
+_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+def load_rules():
+    rules_json = os.environ.get("ALERT_RULES")
+    if not rules_json:
+        return DEFAULT_ALERT_RULES
+    rules = json.loads(rules_json)
+    if not isinstance(rules, list) or not all(isinstance(rule, dict) for rule in rules):
+        raise ValueError("ALERT_RULES must be a JSON list of objects")
+    for rule in rules:
+        missing = {"code", "field", "op", "threshold"} - set(rule)
+        if missing:
+            raise ValueError(f"ALERT_RULES entry {rule} is missing {sorted(missing)}")
+        if rule["op"] not in _OPERATORS:
+            raise ValueError(f"ALERT_RULES entry {rule['code']} has unknown op '{rule['op']}'")
+        if rule["field"] not in RULE_FIELDS:
+            raise ValueError(f"ALERT_RULES entry {rule['code']} has unknown field '{rule['field']}' "
+                             f"(one of {', '.join(RULE_FIELDS)})")
+        # bool is an int subclass, but "true" is not a threshold
+        if isinstance(rule["threshold"], bool) or not isinstance(rule["threshold"], (int, float)):
+            raise ValueError(f"ALERT_RULES entry {rule['code']} has a non-numeric threshold {rule['threshold']!r}")
+        rule.setdefault("label", rule["code"])
+        rule.setdefault("invalid_label", f"Invalid {rule['field']} data")
+    logger.info(f"Loaded {len(rules)} alert rules from ALERT_RULES.")
+    return rules
+
+
+ALERT_RULES = load_rules()
+_LABELS = {rule["code"]: rule["label"] for rule in ALERT_RULES}
+_LABELS.update({f"INVALID_{rule['field'].upper()}": rule["invalid_label"] for rule in ALERT_RULES})
+
+
+def status_code_for(reading, rules=None):
+    """Code of the first threshold rule the reading matches, or "OK"."""
+    for rule in rules or ALERT_RULES:
+        if _OPERATORS[rule["op"]](reading[rule["field"]], rule["threshold"]):
+            return rule["code"]
+    return "OK"
+
+
+def status_codes_for_columns(columns, rules=None):
+    """status_code_for over NumPy columns ({field: array}); returns an object array of codes."""
+    count = len(next(iter(columns.values())))
+    codes = np.full(count, "OK", dtype=object)
+    undecided = np.ones(count, dtype=bool)
+    for rule in rules or ALERT_RULES:
+        matched = _OPERATORS[rule["op"]](columns[rule["field"]], rule["threshold"]) & undecided
+        codes[matched] = rule["code"]
+        undecided &= ~matched
+    return codes
+
+
+def evaluate_batch(readings, rules=None):
+    """Returns the alert codes of each reading, evaluating one rule at a time over the batch."""
+    alert_sets = [[] for _ in readings]
+    for index, reading in enumerate(readings):
+        if reading.get("status_code") in DATA_ISSUE_STATUS_CODES:
+            alert_sets[index].append(reading["status_code"])
+    for rule in rules or ALERT_RULES:
+        compare = _OPERATORS[rule["op"]]
+        field = rule["field"]
+        threshold = rule["threshold"]
+        for index, reading in enumerate(readings):
+            value = reading.get(field)
+            if value is None:
+                continue
+            try:
+                if compare(value, threshold):
+                    alert_sets[index].append(rule["code"])
+            except TypeError: # Values are typed at ingest; anything else is bad data
+                alert_sets[index].append(f"INVALID_{field.upper()}")
+    return alert_sets
+
+
+def alert_status_text(codes):
+    """Human-readable summary used in API responses, e.g. "Low Battery, No/Low Signal"."""
+    labels = []
+    for code in codes:
+        if code in DATA_ISSUE_STATUS_CODES:
+            labels.append(f"Data Issue ({code})")
+        else:
+            labels.append(_LABELS.get(code, code))
+    return ", ".join(labels) if labels else None
+
+
+def annotate_readings(readings):
+    """Stores each reading's alert codes and summary on the document itself."""
+    for reading, codes in zip(readings, evaluate_batch(readings)):
+        reading["alerts"] = codes
+        reading["alert_status"] = alert_status_text(codes)
+    return readings
+
+
+def alert_transitions(readings, previous_states):
+    """Finds alert-set changes per meter across a batch.
+
+    `previous_states` maps MID to the stored latest state ({"alerts", "timestamp"}) before
+    this batch. Readings older than that state are late arrivals and cannot change it.
+    Returns transition documents for the `alerts` collection.
+    """
+    by_mid = {}
+    for reading in readings:
+        by_mid.setdefault(reading["MID"], []).append(reading)
+
+    transitions = []
+    for mid, meter_readings in by_mid.items():
+        state = previous_states.get(mid) or {}
+        current = set(state.get("alerts") or [])
+        last_timestamp = state.get("timestamp")
+        for reading in sorted(meter_readings, key=lambda r: r["timestamp"]):
+            if last_timestamp is not None and reading["timestamp"] < last_timestamp:
+                continue
+            new = set(reading.get("alerts") or [])
+            if new != current:
+                transitions.append({
+                    "MID": mid,
+                    "timestamp": reading["timestamp"],
+                    "from": sorted(current) or ["OK"],
+                    "to": sorted(new) or ["OK"],
+                    "raised": sorted(new - current),
+                    "cleared": sorted(current - new),
+                    "WH": reading.get("WH"),
+                    "battery_vol": reading.get("battery_vol"),
+                    "network": reading.get("network"),
+                })
+            current = new
+            last_timestamp = reading["timestamp"]
+    return transitions
+
+
+def record_transitions(db, readings, previous_states):
+    """Inserts the alert transitions of a written batch; returns how many were recorded."""
+    transitions = alert_transitions(readings, previous_states)
+    if transitions:
+        db[ALERTS_COLLECTION].insert_many(transitions, ordered=False)
+    return len(transitions)
+
+
+def find_alert_transitions(db, meter_id, limit=100):
+    """Most recent alert transitions of one meter, newest first."""
+    cursor = db[ALERTS_COLLECTION].find({"MID": meter_id}, {"_id": 0}).sort("timestamp", DESCENDING).limit(limit)
+    return list(cursor)
+
+
+def find_active_alerts(db):
+    """Meters whose latest reading has alerts: one query on the partial alert_active index."""
+    projection = {"_id": 0, "MID": 1, "timestamp": 1, "alerts": 1, "alert_status": 1,
+                  "status_code": 1, "battery_vol": 1, "network": 1, "WH": 1}
+    return list(db[LATEST_COLLECTION].find({"alert_active": True}, projection).sort("_id", ASCENDING))
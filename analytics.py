@@ -0,0 +1,345 @@
+# analytics.py
+import datetime
+import itertools
+import logging
+import os
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# --- Analytics Settings ---
+# Fleet-wide consumption is derived from the cumulative WH counter: the consumption of an
+# interval is the difference between consecutive readings of a meter, attributed to the
+# UTC day of the later reading. The window should stay within ARCHIVE_RETENTION_DAYS,
+# as archived readings are not read.
+ANALYTICS_WINDOW_DAYS = int(os.environ.get("ANALYTICS_WINDOW_DAYS", "30"))
+# Minimum seconds between incremental refreshes (readings after the last processed one)
+ANALYTICS_REFRESH_S = float(os.environ.get("ANALYTICS_REFRESH_S", "60"))
+# Seconds between full recomputations, which pick up readings written with an older
+# timestamp than one already processed (e.g. write-behind spool replays)
+ANALYTICS_REBUILD_S = float(os.environ.get("ANALYTICS_REBUILD_S", "21600"))
+# Readings younger than this are left for the next refresh, so that concurrent inserts
+# from other workers are not skipped
+ANALYTICS_SETTLE_S = float(os.environ.get("ANALYTICS_SETTLE_S", "30"))
+# Refreshes run on a background thread, so requests never wait for a full recomputation.
+# Before the first one completes, requests wait at most this long and then get a 503.
+ANALYTICS_INITIAL_WAIT_S = float(os.environ.get("ANALYTICS_INITIAL_WAIT_S", "5"))
+# Readings converted to arrays and processed at a time
+ANALYTICS_BATCH_SIZE = int(os.environ.get("ANALYTICS_BATCH_SIZE", "50000"))
+# A drop to at most this fraction of the previous value is a counter reset (the interval
+# consumed the new value); a smaller drop is a negative delta (the interval consumed nothing)
+ANALYTICS_RESET_FRACTION = float(os.environ.get("ANALYTICS_RESET_FRACTION", "0.1"))
+# Night window in UTC hours [start, end); a night is flagged for continuous flow when it
+# has at least ANALYTICS_NIGHT_MIN_INTERVALS intervals, each consuming >= ANALYTICS_NIGHT_MIN_FLOW
+ANALYTICS_NIGHT_START_HOUR = int(os.environ.get("ANALYTICS_NIGHT_START_HOUR", "1"))
+ANALYTICS_NIGHT_END_HOUR = int(os.environ.get("ANALYTICS_NIGHT_END_HOUR", "5"))
+ANALYTICS_NIGHT_MIN_INTERVALS = int(os.environ.get("ANALYTICS_NIGHT_MIN_INTERVALS", "3"))
+ANALYTICS_NIGHT_MIN_FLOW = int(os.environ.get("ANALYTICS_NIGHT_MIN_FLOW", "1"))
+
+ANOMALY_TYPES = ("negative_delta", "counter_reset", "night_flow")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MILLISECOND = datetime.timedelta(milliseconds=1)
+_HOUR_MS = 3600 * 1000
+_DAY_MS = 24 * _HOUR_MS
+
+# Per-(meter, day) grids of a FleetState; night grids are indexed by the day a night starts
+_GRIDS = ("consumption", "readings", "night_intervals", "night_flowing", "night_volume")
+
+
+def _millis(timestamp):
+    return (timestamp - _EPOCH) // _MILLISECOND
+
+
+def _today():
+    return _millis(datetime.datetime.utcnow()) // _DAY_MS
+
+
+def _date_text(day):
+    return (_EPOCH + datetime.timedelta(days=int(day))).strftime('%Y-%m-%d')
+
+
+def _time_text(timestamp):
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S UTC')
+
+
+class FleetState:
+    """Consumption aggregates of every meter over a sliding window of UTC days.
+
+    Per meter (one row each) it keeps the last processed reading and, per day (one column
+    each, `first_day` being the oldest), consumption, reading count and night-flow counts.
+    Readings must be added in (timestamp, _id) order; each batch is processed with array
+    operations, so the cost per reading is a few NumPy element operations.
+    """
+
+    def __init__(self, first_day, width):
+        self.first_day = first_day
+        self.width = width
+        self.position = None # (timestamp, _id) of the last processed reading
+        self.mids = [] # row -> MID
+        self.rows = {} # MID -> row
+        self.last_wh = np.zeros(0, dtype=np.int64)
+        self.last_ts = np.zeros(0, dtype=np.int64)
+        self.has_last = np.zeros(0, dtype=bool)
+        self.grids = {name: np.zeros((0, width), dtype=np.int64) for name in _GRIDS}
+        self.anomalies = [] # Negative deltas and counter resets, oldest first
+
+    def _rows_for(self, mids):
+        """Row index of every MID, adding rows (capacity doubles) for new meters."""
+        unique_mids, inverse = np.unique(np.array(mids, dtype=object).astype(str), return_inverse=True)
+        unique_rows = np.empty(len(unique_mids), dtype=np.intp)
+        for i, mid in enumerate(unique_mids.tolist()):
+            row = self.rows.get(mid)
+            if row is None:
+                row = self.rows[mid] = len(self.mids)
+                self.mids.append(mid)
+            unique_rows[i] = row
+        capacity = len(self.last_wh)
+        if len(self.mids) > capacity:
+            extra = max(len(self.mids), 2 * capacity, 1024) - capacity
+            self.last_wh = np.concatenate((self.last_wh, np.zeros(extra, dtype=np.int64)))
+            self.last_ts = np.concatenate((self.last_ts, np.zeros(extra, dtype=np.int64)))
+            self.has_last = np.concatenate((self.has_last, np.zeros(extra, dtype=bool)))
+            for name, grid in self.grids.items():
+                self.grids[name] = np.concatenate((grid, np.zeros((extra, self.width), dtype=np.int64)))
+        return unique_rows[inverse]
+
+    def advance(self, first_day):
+        """Slides the window so that `first_day` is its oldest day."""
+        shift = first_day - self.first_day
+        if shift <= 0:
+            return
+        for grid in self.grids.values():
+            if shift < self.width:
+                grid[:, :-shift] = grid[:, shift:]
+                grid[:, -shift:] = 0
+            else:
+                grid[:] = 0
+        self.first_day = first_day
+        cutoff = _EPOCH + datetime.timedelta(days=first_day)
+        self.anomalies = [anomaly for anomaly in self.anomalies if anomaly["timestamp"] >= cutoff]
+
+    def add(self, docs):
+        """Adds a batch of {"_id", "MID", "timestamp", "WH"} readings that follow `position`."""
+        if not docs:
+            return
+        rows = self._rows_for([doc["MID"] for doc in docs])
+        timestamps = np.fromiter((_millis(doc["timestamp"]) for doc in docs), dtype=np.int64, count=len(docs))
+        wh = np.fromiter((doc["WH"] for doc in docs), dtype=np.int64, count=len(docs))
+
+        # Group by meter; the sort is stable, so each meter's readings stay in scan order
+        order = np.lexsort((timestamps, rows))
+        rows, timestamps, wh = rows[order], timestamps[order], wh[order]
+        starts_meter = np.ones(len(rows), dtype=bool)
+        starts_meter[1:] = rows[1:] != rows[:-1]
+        ends_meter = np.append(starts_meter[1:], True)
+
+        # Each reading's predecessor: the previous row, or for a meter's first reading in
+        # the batch its last reading from earlier batches
+        previous_wh = np.empty_like(wh)
+        previous_wh[1:] = wh[:-1]
+        previous_wh[starts_meter] = self.last_wh[rows[starts_meter]]
+        previous_ts = np.empty_like(timestamps)
+        previous_ts[1:] = timestamps[:-1]
+        previous_ts[starts_meter] = self.last_ts[rows[starts_meter]]
+        has_previous = np.ones(len(rows), dtype=bool)
+        has_previous[starts_meter] = self.has_last[rows[starts_meter]]
+        self.last_wh[rows[ends_meter]] = wh[ends_meter]
+        self.last_ts[rows[ends_meter]] = timestamps[ends_meter]
+        self.has_last[rows[ends_meter]] = True
+
+        delta = wh - previous_wh
+        dropped = has_previous & (delta < 0)
+        reset = dropped & (wh <= previous_wh * ANALYTICS_RESET_FRACTION)
+        consumption = np.where(has_previous & (delta > 0), delta, 0)
+        consumption[reset] = wh[reset] # Counted up from zero since the reset
+
+        day = timestamps // _DAY_MS - self.first_day
+        in_window = (day >= 0) & (day < self.width)
+        np.add.at(self.grids["consumption"], (rows[in_window], day[in_window]), consumption[in_window])
+        np.add.at(self.grids["readings"], (rows[in_window], day[in_window]), 1)
+
+        # Intervals ending inside the night window, keyed by the day the night starts
+        hour = (timestamps // _HOUR_MS) % 24
+        night_length = (ANALYTICS_NIGHT_END_HOUR - ANALYTICS_NIGHT_START_HOUR) % 24
+        night = (timestamps - ANALYTICS_NIGHT_START_HOUR * _HOUR_MS) // _DAY_MS - self.first_day
+        at_night = (has_previous & ((hour - ANALYTICS_NIGHT_START_HOUR) % 24 < night_length)
+                    & (night >= 0) & (night < self.width))
+        cells = (rows[at_night], night[at_night])
+        np.add.at(self.grids["night_intervals"], cells, 1)
+        np.add.at(self.grids["night_flowing"], cells, consumption[at_night] >= ANALYTICS_NIGHT_MIN_FLOW)
+        np.add.at(self.grids["night_volume"], cells, consumption[at_night])
+
+        for i in np.flatnonzero(dropped).tolist(): # Rare; one event each
+            self.anomalies.append({
+                "MID": self.mids[rows[i]],
+                "type": "counter_reset" if reset[i] else "negative_delta",
+                "timestamp": _EPOCH + datetime.timedelta(milliseconds=int(timestamps[i])),
+                "previous_timestamp": _EPOCH + datetime.timedelta(milliseconds=int(previous_ts[i])),
+                "WH_previous": int(previous_wh[i]),
+                "WH": int(wh[i]),
+            })
+        self.position = (docs[-1]["timestamp"], docs[-1]["_id"])
+
+    def report(self, days, flagged_only=False):
+        """Per-meter totals, daily breakdown and anomalies for the last `days` days (today included)."""
+        columns = slice(max(0, self.width - days), self.width)
+        first_day = self.first_day + columns.start
+        consumption = self.grids["consumption"][:len(self.mids), columns]
+        readings = self.grids["readings"][:len(self.mids), columns]
+        intervals = self.grids["night_intervals"][:len(self.mids), columns]
+        flowing = self.grids["night_flowing"][:len(self.mids), columns]
+        night_flow = (intervals >= ANALYTICS_NIGHT_MIN_INTERVALS) & (flowing == intervals)
+        night_volume = np.where(night_flow, self.grids["night_volume"][:len(self.mids), columns], 0)
+
+        dates = [_date_text(first_day + day) for day in range(self.width - columns.start)]
+        cutoff = _EPOCH + datetime.timedelta(days=first_day)
+        anomalies_by_mid = {}
+        for anomaly in self.anomalies:
+            if anomaly["timestamp"] >= cutoff:
+                anomalies_by_mid.setdefault(anomaly["MID"], []).append(anomaly)
+
+        # Meters with readings in the period, in MID order
+        active = np.flatnonzero(readings.sum(axis=1) > 0)
+        active = active[np.argsort(np.array(self.mids, dtype=object)[active].astype(str), kind="stable")]
+        flagged_rows = set(np.flatnonzero(night_flow.any(axis=1)).tolist())
+        totals = consumption.sum(axis=1)
+        meters = []
+        flag_counts = dict.fromkeys(ANOMALY_TYPES, 0)
+        for row in active.tolist():
+            mid = self.mids[row]
+            flags = sorted({anomaly["type"] for anomaly in anomalies_by_mid.get(mid, [])})
+            if row in flagged_rows:
+                flags.append("night_flow")
+            if flagged_only and not flags:
+                continue
+            for flag in flags:
+                flag_counts[flag] += 1
+            daily_days = np.flatnonzero(readings[row]).tolist()
+            meters.append({
+                "MID": mid,
+                "consumption": int(totals[row]),
+                "readings": int(readings[row].sum()),
+                "daily": [{"date": dates[day], "consumption": int(consumption[row, day]),
+                           "readings": int(readings[row, day])} for day in daily_days],
+                "night_flow": [{"night_of": dates[night], "volume": int(night_volume[row, night]),
+                                "intervals": int(intervals[row, night])}
+                               for night in np.flatnonzero(night_flow[row]).tolist()],
+                "anomalies": [{"type": anomaly["type"], "timestamp": _time_text(anomaly["timestamp"]),
+                               "previous_timestamp": _time_text(anomaly["previous_timestamp"]),
+                               "WH_previous": anomaly["WH_previous"], "WH": anomaly["WH"]}
+                              for anomaly in anomalies_by_mid.get(mid, [])],
+                "flags": flags,
+            })
+        return {
+            "days": days,
+            "from": _date_text(first_day),
+            "through": _time_text(self.position[0]) if self.position else None,
+            "meters": meters,
+            "summary": {"meters": len(meters), "consumption": sum(meter["consumption"] for meter in meters),
+                        "flagged": flag_counts},
+        }
+
+
+class FleetAnalytics:
+    """Per-worker, incrementally refreshed FleetState over MeterStore.iter_fleet_readings.
+
+    A refresh reads only readings after the last processed (timestamp, _id); a full
+    recomputation runs every ANALYTICS_REBUILD_S into a new state, and the previous one is
+    served until it is complete. report() starts due refreshes on a background thread.
+    """
+
+    def __init__(self, iter_readings, window_days=ANALYTICS_WINDOW_DAYS):
+        self._iter_readings = iter_readings
+        self.window_days = window_days
+        self._state = None
+        self._built = threading.Event()
+        self._lock = threading.Lock() # Guards the served state; never held while reading from the store
+        self._refresh_lock = threading.Lock() # One refresh at a time
+        self._refresher = None
+        self._refreshed_at = None
+        self._rebuilt_at = None
+        self._counters = {"refreshes": 0, "rebuilds": 0, "refresh_errors": 0, "readings": 0, "last_refresh_ms": None}
+
+    def _consume(self, state, until, lock=None):
+        """Adds the readings after state.position; `lock` is held per batch if others read `state`."""
+        start_date = _EPOCH + datetime.timedelta(days=state.first_day)
+        docs = iter(self._iter_readings(start_date, until, after=state.position, batch_size=ANALYTICS_BATCH_SIZE))
+        while True:
+            batch = list(itertools.islice(docs, ANALYTICS_BATCH_SIZE))
+            if not batch:
+                return
+            if lock is not None:
+                with lock:
+                    state.add(batch)
+            else:
+                state.add(batch)
+            self._counters["readings"] += len(batch)
+
+    def _is_due(self, now):
+        return self._refreshed_at is None or now - self._refreshed_at >= ANALYTICS_REFRESH_S
+
+    def refresh(self, force=False):
+        """Brings the state up to date unless it was refreshed within ANALYTICS_REFRESH_S."""
+        with self._refresh_lock:
+            now = time.monotonic()
+            if not force and not self._is_due(now):
+                return
+            started = time.perf_counter()
+            until = datetime.datetime.utcnow() - datetime.timedelta(seconds=ANALYTICS_SETTLE_S)
+            first_day = _today() - self.window_days
+            if self._state is None or now - self._rebuilt_at >= ANALYTICS_REBUILD_S:
+                state = FleetState(first_day, self.window_days + 1)
+                self._consume(state, until) # Not served yet, so no lock
+                with self._lock:
+                    self._state = state # Swapped in only once complete
+                self._built.set()
+                self._rebuilt_at = now
+                self._counters["rebuilds"] += 1
+            else:
+                with self._lock:
+                    self._state.advance(first_day)
+                self._consume(self._state, until, lock=self._lock)
+            self._refreshed_at = now
+            self._counters["refreshes"] += 1
+            self._counters["last_refresh_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            logger.debug(f"Fleet analytics refreshed through {self._state.position} "
+                         f"in {self._counters['last_refresh_ms']} ms.")
+
+    def _refresh_in_background(self):
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        if not self._is_due(time.monotonic()):
+            return
+        with self._lock:
+            if self._refresher is not None and self._refresher.is_alive():
+                return
+            self._refresher = threading.Thread(target=self._run_refresh, name="fleet-analytics-refresh", daemon=True)
+            self._refresher.start()
+
+    def _run_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e: # Keep serving the previous state; the next request retries
+            self._counters["refresh_errors"] += 1
+            logger.error(f"Fleet analytics refresh failed: {e}", exc_info=True)
+
+    def report(self, days, flagged_only=False):
+        """The report from the current state, or None if the first computation is still running."""
+        self._refresh_in_background()
+        self._built.wait(ANALYTICS_INITIAL_WAIT_S)
+        with self._lock:
+            if self._state is None:
+                return None
+            return self._state.report(days, flagged_only=flagged_only)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "meters": len(self._state.mids) if self._state is not None else 0,
+                "through": _time_text(self._state.position[0]) if self._state and self._state.position else None,
+                "refreshing": self._refresher is not None and self._refresher.is_alive(),
+                **self._counters,
+            }
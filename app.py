@@ -1,16 +1,35 @@
 # app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 # import pyodbc # REMOVE or comment out
+import collections
 import datetime
-import re
+import itertools
+import json
 import logging
 import os
 from functools import wraps
+import click
 from dotenv import load_dotenv
+from bson.errors import InvalidDocument
 
 # Assuming db_mongo_config.py is in the same directory
 from db_mongo_config import get_db, errors as pymongo_errors # Import MongoDB errors for specific handling
+from alert_rules import alert_status_text, evaluate_batch
+from analytics import ANALYTICS_WINDOW_DAYS, FleetAnalytics
+from archive import ARCHIVE_RETENTION_DAYS, archive_readings
+from db_indexes import check_query_plans, ensure_indexes, index_report
+from history import HISTORY_BATCH_SIZE, HISTORY_MAX_PAGE_SIZE, collect_page, decode_cursor, stream_rows
+from ingest_buffer import INGEST_FLUSH_INTERVAL_S, INGEST_WRITE_BEHIND, IngestBuffer
+from latest_state import LATEST_COLLECTION, rebuild_latest
+from meter_metadata import (METADATA_BULK_MAX_ITEMS, METADATA_CACHE_CHANGE_STREAM, METADATA_COLLECTION,
+                            METADATA_ENRICH_FIELDS, METADATA_MANAGED_FIELDS, MetadataCache)
+from meter_store import LATEST_OUTPUT_FIELDS, METER_STORE, get_store
+from metrics import init_app as init_metrics, record_parse_failures
+from response_formats import encode_payload, negotiated_mimetype, to_columnar
+from response_cache import RESPONSE_CACHE_CHANGE_STREAM, ResponseCache
+from rollups import ROLLUP_COLLECTIONS, rebuild_rollups
+from sms_parser import failure_reason, parse_batch, parse_sms
 
 # Load environment variables from .env file (for local development)
 load_dotenv() 
@@ -28,6 +47,9 @@ if not API_KEY:
 else:
     logger.info("WATER_METER_API_KEY loaded successfully.")
 
+# Upper bound on readings accepted in a single batch submission.
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "50000"))
+
 # --- CORS Setup ---
 # For production, restrict origins
 ALLOWED_CORS_ORIGINS_STR = os.environ.get("ALLOWED_CORS_ORIGINS")
@@ -41,6 +63,57 @@ else:
 app = Flask(__name__)
 CORS(app, origins=origins)
 
+# --- Metrics ---
+# Prometheus metrics at /metrics and the optional slow-request profiler (see metrics.py)
+init_metrics(app)
+
+# --- Storage ---
+# Endpoints go through a MeterStore (meter_store.py): MongoDB by default, or an in-memory
+# store with METER_STORE=memory for load tests and profiling without a cluster.
+store = get_store()
+
+# --- Response Cache ---
+# Per-worker cache of serialized read responses, invalidated by this worker's ingests
+# (and by a change stream if RESPONSE_CACHE_CHANGE_STREAM=true).
+response_cache = ResponseCache()
+
+# --- Fleet Analytics ---
+# Consumption and anomaly aggregates over the last ANALYTICS_WINDOW_DAYS, kept per worker
+# and refreshed incrementally from the last processed reading (see analytics.py).
+fleet_analytics = FleetAnalytics(store.iter_fleet_readings)
+
+# --- Metadata Cache ---
+# Per-worker copy of the metadata fields /api/meters adds to each meter (see meter_metadata.py)
+metadata_cache = MetadataCache(lambda: store.list_metadata(fields=METADATA_ENRICH_FIELDS))
+
+def write_readings(readings):
+    """Stores readings (see ingest.store_readings) and invalidates cached read responses."""
+    results = store.store_readings(readings)
+    response_cache.bump_generation()
+    return results
+
+# --- Write-Behind Ingest (optional) ---
+# With INGEST_WRITE_BEHIND=true, submissions are acknowledged with 202 once queued and
+# written to MongoDB by a background flusher (spooling to local disk during outages).
+ingest_buffer = IngestBuffer(write=write_readings, is_connected=store.is_available) if INGEST_WRITE_BEHIND else None
+
+if RESPONSE_CACHE_CHANGE_STREAM and METER_STORE == "mongo":
+    @app.before_request
+    def start_response_cache_watcher():
+        # Per worker, after fork; a no-op once the watcher thread is running
+        response_cache.start_change_stream(get_db, ["meter_data", LATEST_COLLECTION, METADATA_COLLECTION])
+
+if METADATA_CACHE_CHANGE_STREAM and METER_STORE == "mongo":
+    @app.before_request
+    def start_metadata_cache_watcher():
+        metadata_cache.start_change_stream(get_db)
+
+def ingest_queue_full_response():
+    logger.warning("Ingest queue full; rejecting submission with 429.")
+    response = jsonify({"error": "Ingest queue full, retry later"})
+    response.headers["Retry-After"] = str(max(1, int(INGEST_FLUSH_INTERVAL_S)))
+    return response, 429
+
 
 # --- API Key Decorator --- (same as before)
 def require_api_key(f):
@@ -53,44 +126,56 @@ def require_api_key(f):
             return jsonify({"message": "ERROR: Unauthorized"}), 401
     return decorated_function
 
-# --- SMS Parsing Logic --- (same as before, ensure "WH" or "Liters" is consistent)
+# --- SMS Parsing Logic --- (see sms_parser.py; fields come back typed, "WH" in watt-hours)
 def parse_sms_data(sms_string):
-    match = re.match(r"^\s*([^,]+)\s*,\s*(\w+)\s*,\s*([^,]+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*$", sms_string)
-    if match:
-        start_char, mid, separator_char, battery, network, wh_liters = match.groups() # Use wh_liters
-        parsed = {
-            "MID": mid,
-            "battery_vol": battery,
-            "network": network,
-            "WH": wh_liters # CONSISTENCY: Use "WH" or "Liters" consistently
-        }
-        status_code = "OK"
-        if start_char != "#S" or separator_char != "@": status_code = "FORMAT_WARN"
-        else:
+    parsed = parse_sms(sms_string)
+    if parsed is None:
+        reason = failure_reason(sms_string)
+        record_parse_failures({reason: 1})
+        logger.warning(f"Failed to parse SMS ({reason}): {sms_string}")
+    return parsed
+
+def build_reading(parsed_data, timestamp):
+    """Turns parse_sms_data output into the document stored in meter_data."""
+    # MongoDB stores the server timestamp as an ISODate
+    parsed_data["timestamp"] = timestamp
+    return parsed_data
+
+def read_batch_payloads():
+    """Extracts the sms_payload strings of a batch submission.
+
+    Accepts a JSON array (of strings or {"sms_payload": ...} objects) or an NDJSON body
+    with one such value per line. Returns (payloads, error_message); entries that are not
+    usable payloads are kept as None so results stay aligned with the request.
+    """
+    body = request.get_data(as_text=True)
+    if not body or not body.strip():
+        return None, "Empty request body"
+
+    if request.mimetype in ("application/x-ndjson", "application/jsonl") or not body.lstrip().startswith("["):
+        items = []
+        # Only "\n" ends a line: splitlines() would also split on U+2028 and similar
+        # characters, which JSON strings may contain unescaped
+        for line in body.split("\n"):
+            line = line.removesuffix("\r")
+            if not line.strip():
+                continue
             try:
-                if int(battery) < 3500: status_code = "LOW_BATT"
-                elif int(network) < 10: status_code = "NO_SIGNAL"
-            except ValueError: status_code = "DATA_ERR"
-        parsed["status_code"] = status_code
-        return parsed
-    logger.warning(f"Failed to parse SMS: {sms_string}")
-    return None
-
-# --- Alert Checking Logic (adapts to dictionary input) ---
-def check_meter_alert_status_mongo(meter_data_dict):
-    if not meter_data_dict: return None
-    status_code = meter_data_dict.get("status_code")
-    battery_vol_str = meter_data_dict.get("battery_vol")
-    network_str = meter_data_dict.get("network")
-    alerts = []
-    if status_code in ['FORMAT_WARN', 'DATA_ERR']: alerts.append(f"Data Issue ({status_code})")
-    try:
-        if battery_vol_str and int(battery_vol_str) < 3500: alerts.append("Low Battery")
-    except ValueError: alerts.append("Invalid Battery Data")
-    try:
-        if network_str and int(network_str) < 10: alerts.append("No/Low Signal")
-    except ValueError: alerts.append("Invalid Network Data")
-    return ", ".join(alerts) if alerts else None
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+    else:
+        try:
+            items = json.loads(body)
+        except ValueError as e:
+            return None, f"Invalid JSON array: {e}"
+
+    payloads = []
+    for item in items:
+        if isinstance(item, dict):
+            item = item.get("sms_payload")
+        payloads.append(item if isinstance(item, str) else None)
+    return payloads, None
 
 
 # --- API Endpoints (MongoDB versions) ---
@@ -109,66 +194,117 @@ def submit_data():
     if not parsed_data:
         return jsonify({"error": "Invalid SMS format"}), 400
 
+    if ingest_buffer is not None:
+        parsed_data = build_reading(parsed_data, datetime.datetime.utcnow())
+        if not ingest_buffer.offer([parsed_data]):
+            return ingest_queue_full_response()
+        return jsonify({"message": "Data accepted for processing", "MID": parsed_data['MID']}), 202
+
     try:
-        db = get_db() # Get MongoDB database object
-        meter_data_collection = db["meter_data"] # Collection for readings
-
-        # Add current server timestamp (MongoDB stores BSON Timestamps or ISODates)
-        parsed_data["timestamp"] = datetime.datetime.utcnow()
-        
-        # Convert numeric fields from string if necessary for proper typing in MongoDB
-        parsed_data["battery_vol"] = int(parsed_data["battery_vol"])
-        parsed_data["network"] = int(parsed_data["network"])
-        parsed_data["WH"] = int(parsed_data["WH"]) # Or Liters
-
-        result = meter_data_collection.insert_one(parsed_data)
-        logger.info(f"Data submitted to MongoDB for MID: {parsed_data['MID']}, Inserted ID: {result.inserted_id}")
+        # Add the current server timestamp (parse_sms already returns the numbers as ints)
+        parsed_data = build_reading(parsed_data, datetime.datetime.utcnow())
+
+        # Writes the reading to meter_data and updates the meter's latest state
+        write_error = write_readings([parsed_data])[0]
+        if write_error:
+            logger.error(f"MongoDB Error submitting data for MID {parsed_data['MID']}: {write_error}")
+            return jsonify({"error": "Database error (MongoDB)", "details": write_error}), 500
+        logger.debug(f"Data submitted to MongoDB for MID: {parsed_data['MID']}, Inserted ID: {parsed_data['_id']}")
         return jsonify({"message": "Data submitted successfully", "MID": parsed_data['MID']}), 201
     except pymongo_errors.PyMongoError as e:
         logger.error(f"MongoDB Error submitting data: {e}", exc_info=True)
         return jsonify({"error": "Database error (MongoDB)", "details": str(e)}), 500
-    except ValueError as e: # For int conversion errors
-        logger.error(f"Data type error during submission: {e}", exc_info=True)
-        return jsonify({"error": "Invalid data type for numeric fields.", "details": str(e)}), 400
     except Exception as e:
         logger.error(f"General Error submitting data: {e}", exc_info=True)
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
 
+@app.route('/api/submit-data/batch', methods=['POST'])
+@require_api_key
+def submit_data_batch():
+    payloads, error = read_batch_payloads()
+    if error:
+        logger.warning(f"Submit batch: {error}")
+        return jsonify({"error": error}), 400
+    if len(payloads) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Batch too large: {len(payloads)} items (max {BATCH_MAX_ITEMS})"}), 413
+
+    # Parse everything first (column-wise, see sms_parser.parse_batch); only parseable
+    # readings are sent to the database.
+    timestamp = datetime.datetime.utcnow()
+    columns = parse_batch(payloads)
+    # tolist() gives Python ints, which BSON can encode (NumPy integers it cannot)
+    rows = zip(columns["valid"].tolist(), columns["MID"].tolist(), columns["battery_vol"].tolist(),
+               columns["network"].tolist(), columns["WH"].tolist(), columns["status_code"].tolist())
+    results = []
+    readings = []
+    reading_positions = []
+    rejected_reasons = collections.Counter()
+    for index, (valid, mid, battery, network, wh, status_code) in enumerate(rows):
+        if not valid:
+            error = "Invalid SMS format" if payloads[index] is not None else "Missing sms_payload"
+            results.append({"index": index, "status": "rejected", "error": error})
+            rejected_reasons[columns["reason"][index]] += 1
+            continue
+        results.append({"index": index, "status": "accepted", "MID": mid})
+        parsed_data = {"MID": mid, "battery_vol": battery, "network": network, "WH": wh, "status_code": status_code}
+        readings.append(build_reading(parsed_data, timestamp))
+        reading_positions.append(index)
+    if rejected_reasons:
+        record_parse_failures(rejected_reasons)
+        logger.warning(f"Batch submission: rejected messages by reason: {dict(rejected_reasons)}")
+
+    if readings and ingest_buffer is not None:
+        # All or nothing: a partially queued batch would leave the gateway unsure what to resend
+        if not ingest_buffer.offer(readings):
+            return ingest_queue_full_response()
+    elif readings:
+        try:
+            write_errors = write_readings(readings)
+        except (pymongo_errors.PyMongoError, OverflowError, InvalidDocument) as e:
+            logger.error(f"MongoDB Error submitting batch: {e}", exc_info=True)
+            write_errors = [str(e)] * len(readings)
+        for position, write_error in zip(reading_positions, write_errors):
+            if write_error:
+                results[position]["status"] = "failed"
+                results[position]["error"] = write_error
+
+    summary = {status: sum(1 for r in results if r["status"] == status) for status in ("accepted", "rejected", "failed")}
+    logger.info(f"Batch submitted: {len(results)} items, {summary}")
+    if summary["accepted"] == len(results):
+        http_status = 202 if ingest_buffer is not None else 201
+    else:
+        http_status = 207
+    return jsonify({**summary, "total": len(results), "results": results}), http_status
+
 @app.route('/api/meters', methods=['GET'])
+@response_cache.cached()
 def get_meters():
+    # json: list of meter objects; columnar: one array per field (see response_formats.py)
+    output_format = request.args.get('format', default="json")
+    if output_format not in ("json", "columnar"):
+        return jsonify({"error": f"Invalid format '{output_format}'. Use json or columnar."}), 400
+    mimetype = negotiated_mimetype() if output_format == "columnar" else "application/json"
+    if mimetype is None:
+        return jsonify({"error": "MessagePack encoding is not available on this server"}), 406
+
     try:
-        db = get_db()
-        meter_data_collection = db["meter_data"]
-
-        # MongoDB aggregation to get the latest document for each MID
-        pipeline = [
-            {"$sort": {"timestamp": -1}}, 
-            {"$group": {
-                "_id": "$MID", 
-                "latest_doc": {"$first": "$$ROOT"} 
-            }},
-            {"$replaceRoot": {"newRoot": "$latest_doc"}},
-            {"$project": { # Explicitly project fields to ensure structure and exclude MongoDB _id
-                "_id": 0, 
-                "MID": 1,
-                "WH": 1, 
-                "timestamp": 1,
-                "status_code": 1,
-                "battery_vol": 1,
-                "network": 1
-            }},
-            {"$sort": {"MID": 1}}
-        ]
-        
-        latest_readings_cursor = meter_data_collection.aggregate(pipeline)
-        
+        # One latest-state document per meter (kept current at ingest), so this read
+        # scales with the number of meters rather than the reading history. Metadata
+        # fields come from the per-worker metadata cache.
+        metadata = metadata_cache.get_all()
         meters_list = []
-        for doc in latest_readings_cursor:
-            if isinstance(doc.get("timestamp"), datetime.datetime):
+        for doc in store.list_latest():
+            if isinstance(doc.get("timestamp"), datetime.datetime) and output_format == "json":
                 doc["timestamp"] = doc["timestamp"].strftime('%Y-%m-%d %H:%M:%S UTC')
-            doc["alert_status"] = check_meter_alert_status_mongo(doc)
+            if "alerts" not in doc: # State written before alerts were evaluated at ingest
+                doc["alerts"] = evaluate_batch([doc])[0]
+                doc["alert_status"] = alert_status_text(doc["alerts"])
+            doc.update(metadata.get(doc["MID"]) or dict.fromkeys(METADATA_ENRICH_FIELDS))
             meters_list.append(doc)
-            
+
+        if output_format == "columnar":
+            columns = to_columnar(meters_list, LATEST_OUTPUT_FIELDS + METADATA_ENRICH_FIELDS)
+            return encode_payload({"count": len(meters_list), "columns": columns}, mimetype)
         return jsonify(meters_list)
     except pymongo_errors.PyMongoError as e:
         logger.error(f"MongoDB Error fetching meters: {e}", exc_info=True)
@@ -177,8 +313,52 @@ def get_meters():
         logger.error(f"General Error fetching meters: {e}", exc_info=True)
         return jsonify({"error": "Failed to fetch meters", "details": str(e)}), 500
 
+# Columns of format=columnar history responses
+RAW_HISTORY_FIELDS = ("timestamp", "WH", "battery_vol", "network", "status_code")
+ROLLUP_HISTORY_FIELDS = ("timestamp", "readings", "WH_min", "WH_max", "WH_last", "battery_vol_avg", "network_avg")
+
+def _is_bounded_history_request():
+    # Rollups and first pages are small enough to cache and likely to be asked for again;
+    # raw full-window streams are not, and nor are later pages (one key per cursor)
+    if request.args.get('after'):
+        return False
+    return request.args.get('resolution', 'raw') != 'raw' or 'limit' in request.args
+
 @app.route('/api/meter/<string:meter_id>/history', methods=['GET'])
+@response_cache.cached(when=_is_bounded_history_request)
 def get_meter_history(meter_id):
+    # raw: every reading; hour/day: pre-aggregated buckets from the rollup collections
+    resolution = request.args.get('resolution', default="raw")
+    if resolution != "raw" and resolution not in ROLLUP_COLLECTIONS:
+        return jsonify({"error": f"Invalid resolution '{resolution}'. Use raw, hour or day."}), 400
+
+    # json (array) or ndjson (one reading per line), both streamed; or columnar (one array
+    # per field, JSON or MessagePack by Accept header)
+    default_format = "ndjson" if request.accept_mimetypes.best == "application/x-ndjson" else "json"
+    output_format = request.args.get('format', default=default_format)
+    if output_format not in ("json", "ndjson", "columnar"):
+        return jsonify({"error": f"Invalid format '{output_format}'. Use json, ndjson or columnar."}), 400
+    columnar_mimetype = negotiated_mimetype() if output_format == "columnar" else None
+    if output_format == "columnar" and columnar_mimetype is None:
+        return jsonify({"error": "MessagePack encoding is not available on this server"}), 406
+
+    # Optional keyset pagination: `limit` rows per page, continuing from an `after` token
+    limit = None
+    limit_str = request.args.get('limit')
+    if limit_str is not None:
+        try:
+            limit = min(int(limit_str), HISTORY_MAX_PAGE_SIZE)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return jsonify({"error": f"Invalid 'limit' parameter: {limit_str}"}), 400
+    after = None
+    if request.args.get('after'):
+        try:
+            after = decode_cursor(request.args['after'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
     days_back_str = request.args.get('days', default="30")
     try:
         days_back = int(days_back_str)
@@ -189,33 +369,33 @@ def get_meter_history(meter_id):
         logger.warning(f"Invalid 'days' parameter for history: {days_back_str}. Defaulting to 30.")
 
     start_date = datetime.datetime.utcnow() - datetime.timedelta(days=days_back)
+    fetch_limit = limit + 1 if limit is not None else None # One extra row tells whether another page follows
     
     try:
-        db = get_db()
-        meter_data_collection = db["meter_data"]
-        
-        query = {
-            "MID": meter_id,
-            "timestamp": {"$gte": start_date}
-        }
-        # Project fields to send back and exclude MongoDB's _id
-        projection = {
-            "_id": 0,
-            "timestamp": 1,
-            "WH": 1,
-            "battery_vol": 1,
-            "network": 1,
-            "status_code": 1
-        }
-        history_cursor = meter_data_collection.find(query, projection).sort("timestamp", 1) # Sort ascending by time
-
-        history_list = []
-        for doc in history_cursor:
-            if isinstance(doc.get("timestamp"), datetime.datetime):
-                doc["timestamp"] = doc["timestamp"].strftime('%Y-%m-%d %H:%M:%S UTC')
-            history_list.append(doc)
-            
-        return jsonify(history_list)
+        # Rows carry _id for cursor tokens; it is dropped on output
+        if resolution != "raw":
+            docs = store.iter_rollups(meter_id, start_date, resolution, after=after,
+                                      limit=fetch_limit, batch_size=HISTORY_BATCH_SIZE)
+        else:
+            docs = store.iter_history(meter_id, start_date, after=after,
+                                      limit=fetch_limit, batch_size=HISTORY_BATCH_SIZE)
+
+        if output_format == "columnar":
+            page, next_cursor = collect_page(docs, limit=limit)
+            fields = ROLLUP_HISTORY_FIELDS if resolution != "raw" else RAW_HISTORY_FIELDS
+            payload = {"count": len(page), "columns": to_columnar(page, fields)}
+            if limit is not None:
+                payload["next_cursor"] = next_cursor
+            return encode_payload(payload, columnar_mimetype)
+
+        # Read the first batch before streaming so database errors still produce a 500
+        docs = iter(docs)
+        first_doc = next(docs, None)
+        if first_doc is not None:
+            docs = itertools.chain([first_doc], docs)
+
+        mimetype = "application/x-ndjson" if output_format == "ndjson" else "application/json"
+        return Response(stream_rows(docs, output_format, limit=limit), mimetype=mimetype)
     except pymongo_errors.PyMongoError as e:
         logger.error(f"MongoDB Error fetching history for meter {meter_id}: {e}", exc_info=True)
         return jsonify({"error": f"Failed to fetch history for meter {meter_id} (MongoDB)", "details": str(e)}), 500
@@ -223,37 +403,120 @@ def get_meter_history(meter_id):
         logger.error(f"General Error fetching history for meter {meter_id}: {e}", exc_info=True)
         return jsonify({"error": f"Failed to fetch history for meter {meter_id}", "details": str(e)}), 500
 
-# --- CRUD for Meter Metadata (Example with MongoDB) ---
-# Assume a 'meters_metadata' collection
-# You would add similar CREATE, READ, UPDATE, DELETE routes as before, but using pymongo
+@app.route('/api/alerts/active', methods=['GET'])
+@response_cache.cached()
+def get_active_alerts():
+    try:
+        alerts_list = store.find_active_alerts()
+        for doc in alerts_list:
+            if isinstance(doc.get("timestamp"), datetime.datetime):
+                doc["timestamp"] = doc["timestamp"].strftime('%Y-%m-%d %H:%M:%S UTC')
+        return jsonify(alerts_list)
+    except pymongo_errors.PyMongoError as e:
+        logger.error(f"MongoDB Error fetching active alerts: {e}", exc_info=True)
+        return jsonify({"error": "Failed to fetch active alerts (MongoDB)", "details": str(e)}), 500
+
+@app.route('/api/meter/<string:meter_id>/alerts', methods=['GET'])
+def get_meter_alert_transitions(meter_id):
+    try:
+        limit = max(1, min(int(request.args.get('limit', default="100")), 1000))
+    except ValueError:
+        return jsonify({"error": f"Invalid 'limit' parameter: {request.args.get('limit')}"}), 400
+    try:
+        transitions = store.find_alert_transitions(meter_id, limit=limit)
+        for doc in transitions:
+            doc["timestamp"] = doc["timestamp"].strftime('%Y-%m-%d %H:%M:%S UTC')
+        return jsonify(transitions)
+    except pymongo_errors.PyMongoError as e:
+        logger.error(f"MongoDB Error fetching alert transitions for meter {meter_id}: {e}", exc_info=True)
+        return jsonify({"error": f"Failed to fetch alerts for meter {meter_id} (MongoDB)", "details": str(e)}), 500
+
+@app.route('/api/analytics/consumption', methods=['GET'])
+def get_fleet_consumption():
+    """Per-meter consumption, daily totals and anomaly flags for the whole fleet."""
+    days_str = request.args.get('days', default="7")
+    try:
+        days = int(days_str)
+    except ValueError:
+        days = 0
+    if not 1 <= days <= ANALYTICS_WINDOW_DAYS:
+        return jsonify({"error": f"Invalid 'days' parameter: {days_str} (1 to {ANALYTICS_WINDOW_DAYS})"}), 400
+    # flagged=true: only meters with an anomaly (negative delta, counter reset, night flow)
+    flagged_only = request.args.get('flagged', default="false").lower() == "true"
+
+    try:
+        report = fleet_analytics.report(days, flagged_only=flagged_only)
+        if report is None: # First computation still running in the background
+            return jsonify({"error": "Fleet analytics are being computed; retry shortly."}), 503, {"Retry-After": "10"}
+        return jsonify(report)
+    except pymongo_errors.PyMongoError as e:
+        logger.error(f"MongoDB Error computing fleet analytics: {e}", exc_info=True)
+        return jsonify({"error": "Failed to compute fleet analytics (MongoDB)", "details": str(e)}), 500
+
+@app.route('/api/admin/stats', methods=['GET'])
+@require_api_key
+def get_stats():
+    """Per-worker runtime counters (each gunicorn worker reports its own)."""
+    return jsonify({
+        "pid": os.getpid(),
+        "ingest_buffer": ingest_buffer.stats() if ingest_buffer is not None else {"enabled": False},
+        "response_cache": response_cache.stats(),
+        "fleet_analytics": fleet_analytics.stats(),
+        "metadata_cache": metadata_cache.stats(),
+    })
+
+# --- Meter Metadata (meters_metadata, see meter_metadata.py) ---
+
+def metadata_changed():
+    """Drops this worker's cached metadata and the responses built from it."""
+    metadata_cache.invalidate()
+    response_cache.bump_generation()
+
+def metadata_fields(data):
+    """Client-supplied metadata without the fields the API manages, stamped with LastModified."""
+    fields = {key: value for key, value in data.items() if key not in METADATA_MANAGED_FIELDS}
+    fields["LastModified"] = datetime.datetime.utcnow()
+    return fields
+
+def metadata_json(doc):
+    if "_id" in doc: # Convert ObjectId to string for JSON
+        doc["_id"] = str(doc["_id"])
+    return doc
+
+@app.route('/api/admin/meters', methods=['GET'])
+@require_api_key
+def list_meter_metadata():
+    # Optional paging in MID order: `limit` documents after the MID given as `after`
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        limit = 0
+    if limit is not None and limit <= 0:
+        return jsonify({"error": f"Invalid 'limit' parameter: {request.args.get('limit')}"}), 400
+    try:
+        docs = store.list_metadata(after=request.args.get('after'), limit=limit)
+        return jsonify([metadata_json(doc) for doc in docs])
+    except pymongo_errors.PyMongoError as e:
+        logger.error(f"MongoDB error listing meter metadata: {e}", exc_info=True)
+        return jsonify({"error": "Database error (MongoDB)", "details": str(e)}), 500
 
 @app.route('/api/admin/meters', methods=['POST'])
 @require_api_key
 def create_meter_metadata():
     data = request.json
-    if not data or 'MID' not in data:
+    if not isinstance(data, dict) or not isinstance(data.get('MID'), str) or not data['MID']:
         return jsonify({"error": "Missing MID"}), 400
     
     # Add type conversions and more validation as needed
     # Example: data['InstallationDate'] = datetime.datetime.strptime(data['InstallationDate'], '%Y-%m-%d')
-    # Ensure MID is unique if it's your primary key here
     
     try:
-        db = get_db()
-        metadata_collection = db["meters_metadata"]
-        
-        # Check if MID already exists
-        if metadata_collection.find_one({"MID": data["MID"]}):
+        # One insert; the unique MID index turns an existing MID into a conflict
+        created_doc = store.create_metadata(metadata_fields(data))
+        if created_doc is None:
             return jsonify({"error": f"Meter metadata with MID {data['MID']} already exists."}), 409
-
-        data["LastModified"] = datetime.datetime.utcnow()
-        result = metadata_collection.insert_one(data)
-        # To return the inserted document, you might fetch it again or use the input data
-        # (MongoDB insert_one doesn't return the full doc by default, just inserted_id)
-        created_doc = metadata_collection.find_one({"_id": result.inserted_id})
-        if created_doc and "_id" in created_doc: # Convert ObjectId to string for JSON
-            created_doc["_id"] = str(created_doc["_id"])
-        return jsonify(created_doc), 201
+        metadata_changed()
+        return jsonify(metadata_json(created_doc)), 201
     except pymongo_errors.PyMongoError as e:
         logger.error(f"MongoDB error creating meter metadata: {e}", exc_info=True)
         return jsonify({"error": "Database error (MongoDB)", "details": str(e)}), 500
@@ -261,8 +524,142 @@ def create_meter_metadata():
         logger.error(f"General error creating meter metadata: {e}", exc_info=True)
         return jsonify({"error": "An unexpected error occurred"}), 500
 
-# Add GET (all), GET (one), PUT, DELETE for /api/admin/meters similar to the SQL version,
-# but using metadata_collection.find(), .find_one(), .update_one(), .delete_one()
+@app.route('/api/admin/meters/bulk', methods=['POST'])
+@require_api_key
+def import_meter_metadata():
+    """Creates (mode=insert, the default) or creates-or-updates (mode=upsert) many meters' metadata.
+
+    The body is a JSON array of metadata objects. Results are reported per item, in
+    request order: created, updated, conflict (insert of an existing MID), rejected or failed.
+    """
+    mode = request.args.get('mode', default="insert")
+    if mode not in ("insert", "upsert"):
+        return jsonify({"error": f"Invalid mode '{mode}'. Use insert or upsert."}), 400
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Expected a non-empty JSON array of metadata objects"}), 400
+    if len(items) > METADATA_BULK_MAX_ITEMS:
+        return jsonify({"error": f"Import too large: {len(items)} items (max {METADATA_BULK_MAX_ITEMS})"}), 413
+
+    results = []
+    docs = []
+    doc_positions = []
+    seen_mids = set()
+    for index, item in enumerate(items):
+        mid = item.get('MID') if isinstance(item, dict) else None
+        if not isinstance(mid, str) or not mid:
+            results.append({"index": index, "status": "rejected", "error": "Missing MID"})
+            continue
+        if mid in seen_mids:
+            results.append({"index": index, "MID": mid, "status": "rejected", "error": "Duplicate MID in request"})
+            continue
+        seen_mids.add(mid)
+        results.append({"index": index, "MID": mid})
+        docs.append(metadata_fields(item))
+        doc_positions.append(index)
+
+    if docs:
+        for position, (status, error) in zip(doc_positions, store.write_metadata(docs, upsert=(mode == "upsert"))):
+            results[position]["status"] = status
+            if error:
+                results[position]["error"] = error
+        metadata_changed()
+
+    summary = {status: sum(1 for r in results if r["status"] == status)
+               for status in ("created", "updated", "conflict", "rejected", "failed")}
+    logger.info(f"Metadata import ({mode}): {len(results)} items, {summary}")
+    http_status = 201 if summary["created"] + summary["updated"] == len(results) else 207
+    return jsonify({**summary, "total": len(results), "results": results}), http_status
+
+@app.route('/api/admin/meters/<string:meter_id>', methods=['GET'])
+@require_api_key
+def get_meter_metadata(meter_id):
+    try:
+        doc = store.find_metadata(meter_id)
+    except pymongo_errors.PyMongoError as e:
+        logger.error(f"MongoDB error fetching metadata for meter {meter_id}: {e}", exc_info=True)
+        return jsonify({"error": "Database error (MongoDB)", "details": str(e)}), 500
+    if doc is None:
+        return jsonify({"error": f"No metadata for meter {meter_id}"}), 404
+    return jsonify(metadata_json(doc))
+
+@app.route('/api/admin/meters/<string:meter_id>', methods=['PUT'])
+@require_api_key
+def update_meter_metadata(meter_id):
+    """Sets the given fields on a meter's metadata; fields not in the body are kept."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data:
+        return jsonify({"error": "Expected a JSON object of metadata fields"}), 400
+    if data.get('MID', meter_id) != meter_id:
+        return jsonify({"error": "MID cannot be changed"}), 400
+    try:
+        doc = store.update_metadata(meter_id, metadata_fields(data))
+    except pymongo_errors.PyMongoError as e:
+        logger.error(f"MongoDB error updating metadata for meter {meter_id}: {e}", exc_info=True)
+        return jsonify({"error": "Database error (MongoDB)", "details": str(e)}), 500
+    if doc is None:
+        return jsonify({"error": f"No metadata for meter {meter_id}"}), 404
+    metadata_changed()
+    return jsonify(metadata_json(doc))
+
+@app.route('/api/admin/meters/<string:meter_id>', methods=['DELETE'])
+@require_api_key
+def delete_meter_metadata(meter_id):
+    try:
+        deleted = store.delete_metadata(meter_id)
+    except pymongo_errors.PyMongoError as e:
+        logger.error(f"MongoDB error deleting metadata for meter {meter_id}: {e}", exc_info=True)
+        return jsonify({"error": "Database error (MongoDB)", "details": str(e)}), 500
+    if not deleted:
+        return jsonify({"error": f"No metadata for meter {meter_id}"}), 404
+    metadata_changed()
+    return jsonify({"message": f"Metadata for meter {meter_id} deleted"})
+
+
+# --- Maintenance Commands (run with `flask --app app <command>`) ---
+
+@app.cli.command("rebuild-meters-latest")
+def rebuild_meters_latest_command():
+    """Regenerates the meters_latest collection from meter_data."""
+    count = rebuild_latest(get_db())
+    print(f"{LATEST_COLLECTION} rebuilt: {count} meters.")
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Regenerates the hourly and daily rollup collections from meter_data."""
+    for resolution, count in rebuild_rollups(get_db()).items():
+        print(f"{ROLLUP_COLLECTIONS[resolution]} rebuilt: {count} buckets.")
+
+@app.cli.command("archive-readings")
+@click.option("--days", default=ARCHIVE_RETENTION_DAYS, show_default=True, type=click.IntRange(min=1),
+              help="Archive raw readings older than this many days.")
+def archive_readings_command(days):
+    """Moves old raw readings from meter_data into compressed archive segments (see archive.py)."""
+    totals = archive_readings(get_db(), days=days)
+    print(f"Archived {totals['readings']} readings of {totals['meters']} meters into {totals['segments']} segments.")
+
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Creates the declared indexes and reports missing, unused and undeclared ones."""
+    db = get_db()
+    ensure_indexes(db)
+    for collection_name, report in index_report(db).items():
+        print(f"{collection_name}: missing={report['missing']} unused={report['unused']} undeclared={report['undeclared']}")
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    """Explains every endpoint query shape; exits non-zero if any falls back to COLLSCAN."""
+    db = get_db()
+    missing = {name: report["missing"] for name, report in index_report(db).items() if report["missing"]}
+    failures = check_query_plans(db)
+    for collection_name, names in missing.items():
+        print(f"MISSING on {collection_name}: {names}")
+    for shape_name, stages in failures:
+        print(f"COLLSCAN in '{shape_name}': {' -> '.join(stages)}")
+    if missing or failures:
+        raise SystemExit(1)
+    print("All declared indexes exist and every query shape uses an index.")
 
 
 if __name__ == '__main__':
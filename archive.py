@@ -0,0 +1,206 @@
+# archive.py
+import datetime
+import functools
+import heapq
+import logging
+import os
+import numpy as np
+from bson import ObjectId
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# --- Archive Settings ---
+# Raw readings older than the retention window move out of meter_data into one
+# compressed columnar file per meter and month under ARCHIVE_DIR (a local directory or
+# a mounted object-store bucket). Rollups, latest states and alert transitions stay in
+# MongoDB; the history endpoint reads archived ranges back through the segment index.
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("ARCHIVE_RETENTION_DAYS", "180"))
+# Decoded segments kept per worker for history reads
+ARCHIVE_SEGMENT_CACHE_SIZE = int(os.environ.get("ARCHIVE_SEGMENT_CACHE_SIZE", "32"))
+# meter_data documents removed per delete_many once their segment is written
+ARCHIVE_DELETE_CHUNK_SIZE = 1000
+
+# One document per segment file: {MID, month, start, end, count, path, bytes, version}
+ARCHIVE_SEGMENTS_COLLECTION = "archive_segments"
+
+# Columns kept per reading: what the raw history endpoint returns
+ARCHIVE_INT_FIELDS = ("WH", "battery_vol", "network")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+
+def month_start(timestamp):
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def segment_path(mid, month):
+    """Segment file path relative to ARCHIVE_DIR, e.g. "M001/2025-01.npz"."""
+    return os.path.join(mid, f"{month:%Y-%m}.npz")
+
+
+# --- Segment Files ---
+
+def _to_columns(docs):
+    # _id as S12 bytes: NumPy strips trailing NUL bytes on access (see _segment_rows) but
+    # compares and sorts S12 values exactly like the 12-byte ObjectIds
+    return {
+        "_id": np.array([doc["_id"].binary for doc in docs], dtype="S12"),
+        "timestamp": np.array([(doc["timestamp"] - _EPOCH) // _MILLISECOND for doc in docs], dtype=np.int64),
+        **{field: np.array([doc[field] for doc in docs], dtype=np.int64) for field in ARCHIVE_INT_FIELDS},
+        "status_code": np.array([doc.get("status_code") or "" for doc in docs], dtype=str),
+    }
+
+
+def _merge_columns(old, new):
+    """Concatenates two segments, ordered by (timestamp, _id) and without duplicate _ids."""
+    merged = {field: np.concatenate((old[field], new[field])) for field in new}
+    order = np.lexsort((merged["_id"], merged["timestamp"]))
+    merged = {field: values[order] for field, values in merged.items()}
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = merged["_id"][1:] != merged["_id"][:-1] # Same _id implies same timestamp, so duplicates are adjacent
+    return {field: values[keep] for field, values in merged.items()}
+
+
+def _read_columns(path):
+    with np.load(os.path.join(ARCHIVE_DIR, path)) as segment:
+        return {field: segment[field] for field in segment.files}
+
+
+def _write_columns(path, columns):
+    """Writes a segment atomically (temporary file, fsync, rename); returns its size."""
+    full_path = os.path.join(ARCHIVE_DIR, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    temp_path = f"{full_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez_compressed(f, **columns)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, full_path)
+    return os.path.getsize(full_path)
+
+
+@functools.lru_cache(maxsize=ARCHIVE_SEGMENT_CACHE_SIZE)
+def _cached_columns(path, version):
+    # version changes whenever the segment is rewritten, so stale entries are never hit
+    return _read_columns(path)
+
+
+# --- Retention Job ---
+
+def _archive_month(db, mid, month, docs):
+    """Appends docs to the meter's segment for `month`, then removes them from meter_data."""
+    path = segment_path(mid, month)
+    columns = _to_columns(docs)
+    existing = db[ARCHIVE_SEGMENTS_COLLECTION].find_one({"MID": mid, "month": month})
+    if existing is not None:
+        columns = _merge_columns(_read_columns(existing["path"]), columns)
+    size = _write_columns(path, columns)
+
+    # Index the file before deleting anything, so every reading is always readable from
+    # meter_data or the archive (both, after an interrupted run; readers deduplicate).
+    db[ARCHIVE_SEGMENTS_COLLECTION].update_one(
+        {"MID": mid, "month": month},
+        {"$set": {"path": path, "bytes": size, "count": len(columns["_id"]),
+                  "start": _EPOCH + datetime.timedelta(milliseconds=int(columns["timestamp"][0])),
+                  "end": _EPOCH + datetime.timedelta(milliseconds=int(columns["timestamp"][-1])),
+                  "version": ObjectId()}},
+        upsert=True)
+    for i in range(0, len(docs), ARCHIVE_DELETE_CHUNK_SIZE):
+        ids = [doc["_id"] for doc in docs[i:i + ARCHIVE_DELETE_CHUNK_SIZE]]
+        db["meter_data"].delete_many({"_id": {"$in": ids}})
+
+
+def archive_readings(db, days=ARCHIVE_RETENTION_DAYS):
+    """Moves raw readings older than `days` days from meter_data into archive segments.
+
+    Works meter by meter and month by month, reading each meter's old readings in
+    (timestamp, _id) order on the (MID, timestamp) index. Only the columns the history
+    endpoint returns are kept. Safe to re-run after a failure. Returns
+    {"meters", "segments", "readings"} counts.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    projection = {"_id": 1, "timestamp": 1, "status_code": 1, **{field: 1 for field in ARCHIVE_INT_FIELDS}}
+    totals = {"meters": 0, "segments": 0, "readings": 0}
+    for mid in db["meter_data"].distinct("MID"):
+        cursor = db["meter_data"].find({"MID": mid, "timestamp": {"$lt": cutoff}}, projection).sort(
+            [("timestamp", ASCENDING), ("_id", ASCENDING)])
+        month, docs = None, []
+        for doc in cursor:
+            if docs and doc["timestamp"] >= _next_month(month):
+                _archive_month(db, mid, month, docs)
+                totals["segments"] += 1
+                totals["readings"] += len(docs)
+                docs = []
+            if not docs:
+                month = month_start(doc["timestamp"])
+            docs.append(doc)
+        if docs:
+            _archive_month(db, mid, month, docs)
+            totals["segments"] += 1
+            totals["readings"] += len(docs)
+        if month is not None:
+            totals["meters"] += 1
+    logger.info(f"Archived readings older than {cutoff:%Y-%m-%d %H:%M}: {totals}")
+    return totals
+
+
+# --- Reads ---
+
+def _segment_rows(columns, start_date, after):
+    """Yields a segment's rows from start_date on and strictly after the (timestamp, _id) `after`."""
+    timestamps = columns["timestamp"]
+    position = np.searchsorted(timestamps, (start_date - _EPOCH) // _MILLISECOND, side="left")
+    if after is not None:
+        after_millis = (after[0] - _EPOCH) // _MILLISECOND
+        position = max(position, np.searchsorted(timestamps, after_millis, side="left"))
+        after_id = after[1].binary
+        while position < len(timestamps) and timestamps[position] == after_millis and columns["_id"][position] <= after_id:
+            position += 1
+    ids = columns["_id"]
+    status_codes = columns["status_code"]
+    int_columns = [(field, columns[field]) for field in ARCHIVE_INT_FIELDS]
+    for i in range(position, len(timestamps)):
+        row = {"_id": ObjectId(bytes(ids[i]).ljust(12, b"\0")),
+               "timestamp": _EPOCH + datetime.timedelta(milliseconds=int(timestamps[i]))}
+        for field, values in int_columns:
+            row[field] = int(values[i])
+        row["status_code"] = str(status_codes[i])
+        yield row
+
+
+def archived_segments(db, meter_id, start_date, after=None):
+    """Index entries of the meter's segments that reach start_date (and the `after` position), oldest first."""
+    earliest = max(start_date, after[0]) if after is not None else start_date
+    return list(db[ARCHIVE_SEGMENTS_COLLECTION].find(
+        {"MID": meter_id, "end": {"$gte": earliest}}, {"path": 1, "version": 1}).sort("month", ASCENDING))
+
+
+def iter_archived(segments, start_date, after=None):
+    """Rows of the given segments from start_date on, ordered by (timestamp, _id)."""
+    for segment in segments:
+        yield from _segment_rows(_cached_columns(segment["path"], segment["version"]), start_date, after)
+
+
+def merge_history(archived, live, limit=None):
+    """Merges archived and live rows (each ordered by (timestamp, _id)), dropping duplicates.
+
+    A reading is in both only after an interrupted archive run.
+    """
+    previous_key = None
+    emitted = 0
+    for doc in heapq.merge(archived, live, key=lambda doc: (doc["timestamp"], doc["_id"])):
+        key = (doc["timestamp"], doc["_id"])
+        if key == previous_key:
+            continue
+        previous_key = key
+        yield doc
+        emitted += 1
+        if limit is not None and emitted >= limit:
+            return
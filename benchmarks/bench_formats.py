@@ -0,0 +1,96 @@
+# benchmarks/bench_formats.py
+"""Compares the row and columnar encodings of a meter history response.
+
+Usage: python benchmarks/bench_formats.py [--rows 100000] [--repeat 3]
+
+Builds synthetic history documents shaped like meter_data (as returned by the history
+query) and reports encoded size and best-of-N encode time for each format.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from history import stream_rows
+from response_formats import msgpack, to_columnar
+
+RAW_FIELDS = ("timestamp", "WH", "battery_vol", "network", "status_code")
+
+
+def synthetic_history(rows):
+    start = datetime.datetime(2025, 1, 1)
+    docs = []
+    for i in range(rows):
+        docs.append({
+            "_id": ObjectId(),
+            "timestamp": start + datetime.timedelta(minutes=5 * i),
+            "WH": 100000 + i * 3,
+            "battery_vol": 3600 - (i % 200),
+            "network": 5 + i % 25,
+            "status_code": "OK" if i % 50 else "NO_SIGNAL",
+        })
+    return docs
+
+
+def row_json(docs):
+    # The pre-columnar response: strftime per row, then one JSON object per row
+    rows = []
+    for doc in docs:
+        row = {field: doc[field] for field in RAW_FIELDS}
+        row["timestamp"] = row["timestamp"].strftime('%Y-%m-%d %H:%M:%S UTC')
+        rows.append(row)
+    return json.dumps(rows, sort_keys=True).encode()
+
+
+def row_json_streamed(docs):
+    return "".join(stream_rows(iter(docs), "json")).encode()
+
+
+def columnar_json(docs):
+    return json.dumps({"count": len(docs), "columns": to_columnar(docs, RAW_FIELDS)}, separators=(",", ":")).encode()
+
+
+def columnar_msgpack(docs):
+    return msgpack.packb({"count": len(docs), "columns": to_columnar(docs, RAW_FIELDS)}, use_bin_type=True)
+
+
+def measure(encode, docs, repeat):
+    best = None
+    body = b""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = encode(docs)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(body), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    docs = synthetic_history(args.rows)
+    encoders = [("row json (jsonify-style)", row_json), ("row json (streamed)", row_json_streamed),
+                ("columnar json", columnar_json)]
+    if msgpack is not None:
+        encoders.append(("columnar msgpack", columnar_msgpack))
+    else:
+        print("msgpack not installed; skipping columnar msgpack")
+
+    baseline_bytes, baseline_time = measure(row_json, docs, args.repeat)
+    print(f"{args.rows} readings, best of {args.repeat}")
+    print(f"{'format':28} {'bytes':>12} {'vs row':>8} {'encode ms':>10} {'vs row':>8}")
+    for name, encode in encoders:
+        size, elapsed = measure(encode, docs, args.repeat)
+        print(f"{name:28} {size:12d} {size / baseline_bytes:8.2f} {elapsed * 1000:10.1f} {elapsed / baseline_time:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# benchmarks/bench_parser.py
+"""Benchmarks the SMS parsers against the original regex parser.
+
+Usage:
+    python benchmarks/bench_parser.py [--messages 1000000] [--repeat 3]
+
+The benchmark parses synthetic gateway traffic (mostly well-formed "#S,MID,@,batt,net,wh"
+messages, plus whitespace variants, wrong markers and junk) with the original parser
+(regex, then int() conversions), sms_parser.parse_sms per message and
+sms_parser.parse_batch, and reports best-of-N time and messages per second.
+
+Parity with the original parser is tested in tests/test_sms_parser.py (legacy_parse
+below is the reference).
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alert_rules import status_code_for
+from sms_parser import parse_batch, parse_sms
+
+
+def legacy_parse(sms_string):
+    """The parser app.py used before sms_parser.py, followed by build_reading's int() calls."""
+    match = re.match(r"^\s*([^,]+)\s*,\s*(\w+)\s*,\s*([^,]+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*$", sms_string)
+    if not match:
+        return None
+    start_char, mid, separator_char, battery, network, wh_liters = match.groups()
+    parsed = {"MID": mid, "battery_vol": battery, "network": network, "WH": wh_liters}
+    status_code = "OK"
+    if start_char != "#S" or separator_char != "@":
+        status_code = "FORMAT_WARN"
+    else:
+        try:
+            status_code = status_code_for({"battery_vol": int(battery), "network": int(network)})
+        except ValueError:
+            status_code = "DATA_ERR"
+    parsed["status_code"] = status_code
+    try:
+        parsed["battery_vol"] = int(parsed["battery_vol"])
+        parsed["network"] = int(parsed["network"])
+        parsed["WH"] = int(parsed["WH"])
+    except ValueError: # The submission was rejected with 400
+        return None
+    return parsed
+
+
+def synthetic_traffic(count, seed):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        mid = f"M{rng.randint(0, 99999):05d}"
+        battery, network, wh = rng.randint(3000, 4200), rng.randint(0, 31), rng.randint(0, 10 ** 7)
+        kind = rng.random()
+        if kind < 0.97:
+            messages.append(f"#S,{mid},@,{battery},{network},{wh}")
+        elif kind < 0.985:
+            messages.append(f" #S , {mid} ,@, {battery},{network} ,{wh}\n")
+        elif kind < 0.995:
+            messages.append(f"#X,{mid},@,{battery},{network},{wh}")
+        else:
+            messages.append(f"#S,{mid},@,{battery},n/a,{wh}")
+    return messages
+
+
+def run_batch(messages):
+    return parse_batch(messages)
+
+
+def run_single(messages):
+    return [parse_sms(message) for message in messages]
+
+
+def run_legacy(messages):
+    return [legacy_parse(message) for message in messages]
+
+
+def measure(parse, messages, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parse(messages)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    messages = synthetic_traffic(args.messages, args.seed)
+    print(f"{args.messages} messages, best of {args.repeat}")
+    print(f"{'parser':24} {'seconds':>9} {'msg/s':>12} {'vs original':>12}")
+    baseline = None
+    for name, parse in (("original (regex + int)", run_legacy), ("parse_sms", run_single), ("parse_batch", run_batch)):
+        elapsed = measure(parse, messages, args.repeat)
+        baseline = baseline or elapsed
+        print(f"{name:24} {elapsed:9.3f} {args.messages / elapsed:12.0f} {baseline / elapsed:11.2f}x")
+
+
+if __name__ == "__main__":
+    main()
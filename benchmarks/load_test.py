@@ -0,0 +1,266 @@
+# benchmarks/load_test.py
+"""Replays synthetic gateway traffic against the API and reports latency per endpoint.
+
+Usage:
+    python benchmarks/load_test.py [--requests 5000] [--threads 8] [--meters 200]
+    python benchmarks/load_test.py --gunicorn [--workers 2] [--gunicorn-threads 4]
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --api-key KEY
+
+By default the app runs in this process (Flask test client) on the in-memory MeterStore,
+so no database is needed; --store mongo uses MONGO_URI instead. --gunicorn starts the app
+under gunicorn.conf.py on a local port, and --url targets a server that is already
+running. With the in-memory store every gunicorn worker holds its own data.
+
+Traffic is a weighted mix of single and batch submissions of "#S,MID,@,batt,net,wh" SMS
+payloads and the read endpoints. For each endpoint the report shows requests, errors
+(HTTP status >= 400), throughput and p50/p99 latency. --max-p99-ms makes the run exit
+non-zero if any endpoint's p99 is above the limit, for use as a local regression check.
+"""
+import argparse
+import collections
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_API_KEY = "load-test-key"
+
+# (endpoint name, weight); weights are relative
+TRAFFIC_MIX = (
+    ("submit", 50),
+    ("submit batch", 5),
+    ("meters", 10),
+    ("history page", 15),
+    ("history hour", 10),
+    ("alerts active", 5),
+    ("meter alerts", 5),
+)
+
+
+# --- Synthetic Traffic ---
+
+def sms_payload(rng, meter_ids, counters):
+    """One gateway message; WH only grows, battery and signal drift into alert range."""
+    mid = rng.choice(meter_ids)
+    counters[mid] += rng.randint(0, 40)
+    battery = rng.randint(3300, 4200)
+    network = rng.randint(0, 31)
+    return f"#S,{mid},@,{battery},{network},{counters[mid]}"
+
+
+def build_request(name, rng, meter_ids, counters, batch_size):
+    """Returns (method, path, json body) for one request of the given endpoint."""
+    if name == "submit":
+        return "POST", "/api/submit-data", {"sms_payload": sms_payload(rng, meter_ids, counters)}
+    if name == "submit batch":
+        return "POST", "/api/submit-data/batch", [sms_payload(rng, meter_ids, counters) for _ in range(batch_size)]
+    if name == "meters":
+        return "GET", "/api/meters", None
+    if name == "history page":
+        return "GET", f"/api/meter/{rng.choice(meter_ids)}/history?days=1&limit=500", None
+    if name == "history hour":
+        return "GET", f"/api/meter/{rng.choice(meter_ids)}/history?days=7&resolution=hour", None
+    if name == "alerts active":
+        return "GET", "/api/alerts/active", None
+    if name == "meter alerts":
+        return "GET", f"/api/meter/{rng.choice(meter_ids)}/alerts?limit=50", None
+    raise ValueError(f"Unknown endpoint '{name}'")
+
+
+# --- Clients ---
+
+class InProcessClient:
+    """Calls the app through Flask's test client (one per thread)."""
+
+    def __init__(self, app, api_key):
+        self._client = app.test_client()
+        self._headers = {"X-API-KEY": api_key}
+
+    def request(self, method, path, body):
+        response = self._client.open(path, method=method, json=body, headers=self._headers)
+        response.get_data() # Drain streamed bodies so their cost is measured
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class HttpClient:
+    """Calls a running server over a keep-alive HTTP connection (one per thread)."""
+
+    def __init__(self, base_url, api_key):
+        url = urllib.parse.urlsplit(base_url)
+        self._connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        self._headers = {"X-API-KEY": api_key, "Content-Type": "application/json"}
+
+    def request(self, method, path, body):
+        payload = json.dumps(body) if body is not None else None
+        try:
+            self._connection.request(method, path, body=payload, headers=self._headers)
+            response = self._connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self._connection.close() # Reconnects on the next request
+            return 599
+
+    def close(self):
+        self._connection.close()
+
+
+def start_gunicorn(port, workers, threads, env):
+    """Starts the app under gunicorn.conf.py and waits until it answers."""
+    command = [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "app:app",
+               "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "--threads", str(threads)]
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"gunicorn exited with status {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("gunicorn did not start within 30 seconds")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# --- Load Generation ---
+
+def run_worker(client, plan, results, lock):
+    timings = collections.defaultdict(list)
+    errors = collections.Counter()
+    for name, method, path, body in plan:
+        started = time.perf_counter()
+        status = client.request(method, path, body)
+        timings[name].append(time.perf_counter() - started)
+        if status >= 400:
+            errors[name] += 1
+    client.close()
+    with lock:
+        for name, values in timings.items():
+            results["timings"][name].extend(values)
+        results["errors"].update(errors)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def make_plans(args, meter_ids):
+    rng = random.Random(args.seed)
+    counters = collections.Counter({mid: rng.randint(0, 100000) for mid in meter_ids})
+    names = [name for name, _ in TRAFFIC_MIX]
+    weights = [weight for _, weight in TRAFFIC_MIX]
+    plans = [[] for _ in range(args.threads)]
+    for i in range(args.requests):
+        name = rng.choices(names, weights)[0]
+        plans[i % args.threads].append((name, *build_request(name, rng, meter_ids, counters, args.batch_size)))
+    seed = [("seed", *build_request("submit batch", rng, meter_ids, counters, args.batch_size))
+            for _ in range(args.seed_batches)]
+    return seed, plans
+
+
+def report(results, elapsed, max_p99_ms):
+    print(f"{'endpoint':16} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    total = 0
+    over_limit = []
+    for name, _ in TRAFFIC_MIX:
+        values = sorted(results["timings"].get(name, []))
+        if not values:
+            continue
+        total += len(values)
+        p50, p99 = percentile(values, 0.50) * 1000, percentile(values, 0.99) * 1000
+        print(f"{name:16} {len(values):9d} {results['errors'][name]:7d} {len(values) / elapsed:9.1f} {p50:9.2f} {p99:9.2f}")
+        if max_p99_ms is not None and p99 > max_p99_ms:
+            over_limit.append(name)
+    print(f"{'total':16} {total:9d} {sum(results['errors'].values()):7d} {total / elapsed:9.1f}")
+    return over_limit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000, help="requests in the measured run")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent client threads")
+    parser.add_argument("--meters", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=100, help="readings per batch submission")
+    parser.add_argument("--seed-batches", type=int, default=50, help="batches submitted before measuring")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the traffic")
+    parser.add_argument("--store", choices=("memory", "mongo"), default="memory")
+    parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    parser.add_argument("--gunicorn", action="store_true", help="run the app under gunicorn")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--gunicorn-threads", type=int, default=4, help="threads per gunicorn worker")
+    parser.add_argument("--url", help="benchmark an already running server instead")
+    parser.add_argument("--api-key", default=os.environ.get("WATER_METER_API_KEY", DEFAULT_API_KEY))
+    parser.add_argument("--max-p99-ms", type=float, help="exit 1 if any endpoint's p99 exceeds this")
+    args = parser.parse_args()
+
+    env = dict(os.environ, METER_STORE=args.store, WATER_METER_API_KEY=args.api_key)
+    if args.no_cache:
+        env["RESPONSE_CACHE_ENABLED"] = "false"
+
+    server = None
+    if args.url:
+        target = args.url
+        make_client = lambda: HttpClient(args.url, args.api_key)
+    elif args.gunicorn:
+        port = free_port()
+        server = start_gunicorn(port, args.workers, args.gunicorn_threads, env)
+        target = f"gunicorn, {args.workers} workers x {args.gunicorn_threads} threads"
+        make_client = lambda: HttpClient(f"http://127.0.0.1:{port}", args.api_key)
+    else:
+        os.environ.update(env) # Read by the app's modules at import
+        from app import app
+        target = "in-process"
+        make_client = lambda: InProcessClient(app, args.api_key)
+
+    try:
+        meter_ids = [f"LT{i:05d}" for i in range(args.meters)]
+        seed, plans = make_plans(args, meter_ids)
+        seed_results = {"timings": collections.defaultdict(list), "errors": collections.Counter()}
+        run_worker(make_client(), seed, seed_results, threading.Lock())
+        if seed_results["errors"]["seed"]:
+            print(f"warning: {seed_results['errors']['seed']} of {len(seed)} seed batches failed")
+
+        results = {"timings": collections.defaultdict(list), "errors": collections.Counter()}
+        lock = threading.Lock()
+        threads = [threading.Thread(target=run_worker, args=(make_client(), plan, results, lock)) for plan in plans]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    print(f"{args.requests} requests, {args.threads} client threads, {target}, store={args.store}, "
+          f"cache={'off' if args.no_cache else 'on'}, {elapsed:.2f}s")
+    over_limit = report(results, elapsed, args.max_p99_ms)
+    if over_limit:
+        print(f"p99 above {args.max_p99_ms} ms: {', '.join(over_limit)}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# db_indexes.py
+import datetime
+import logging
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, errors
+
+from alert_rules import ALERTS_COLLECTION
+from archive import ARCHIVE_SEGMENTS_COLLECTION
+from latest_state import LATEST_COLLECTION
+from meter_metadata import METADATA_COLLECTION
+from rollups import ROLLUP_COLLECTIONS
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# --- Declared Indexes ---
+# Every index the endpoints rely on, per collection. ensure_indexes() creates them and
+# index_report() compares them with what actually exists on the server. background is
+# ignored by MongoDB 4.2+ (whose builds never hold the exclusive lock throughout) but
+# keeps older servers from blocking the collection while an index builds.
+REQUIRED_INDEXES = {
+    "meter_data": [
+        # get_meter_history: {"MID": ..., "timestamp": {"$gte": ...}} sorted by (timestamp, _id)
+        IndexModel([("MID", ASCENDING), ("timestamp", ASCENDING)], name="MID_1_timestamp_1", background=True),
+        # FleetAnalytics refreshes: every meter's readings after a (timestamp, _id) position
+        IndexModel([("timestamp", ASCENDING), ("_id", ASCENDING)], name="timestamp_1__id_1", background=True),
+    ],
+    LATEST_COLLECTION: [
+        # find_active_alerts: {"alert_active": True} sorted by _id. Partial, so only meters
+        # currently in alert are indexed.
+        IndexModel([("alert_active", ASCENDING), ("_id", ASCENDING)], name="alert_active_1__id_1",
+                   partialFilterExpression={"alert_active": True}, background=True),
+    ],
+    ALERTS_COLLECTION: [
+        # find_alert_transitions: {"MID": ...} newest first
+        IndexModel([("MID", ASCENDING), ("timestamp", ASCENDING)], name="MID_1_timestamp_1", background=True),
+    ],
+    METADATA_COLLECTION: [
+        # Metadata by MID and in MID order; unique, so creates and bulk imports get a
+        # duplicate key error (a conflict) for a MID that already has a document
+        IndexModel([("MID", ASCENDING)], name="MID_1", unique=True, background=True),
+    ],
+    ARCHIVE_SEGMENTS_COLLECTION: [
+        # archived_segments: {"MID": ..., "end": {"$gte": ...}} sorted by month; one segment per meter and month
+        IndexModel([("MID", ASCENDING), ("month", ASCENDING)], name="MID_1_month_1", unique=True, background=True),
+    ],
+}
+for _rollup_collection in ROLLUP_COLLECTIONS.values():
+    # Upsert target of apply_rollups (unique so $merge in rebuild_rollups can match on it)
+    # and the range read of find_rollups.
+    REQUIRED_INDEXES[_rollup_collection] = [
+        IndexModel([("MID", ASCENDING), ("bucket", ASCENDING)], name="MID_1_bucket_1", unique=True, background=True),
+    ]
+
+# --- Query Shapes ---
+# The queries the endpoints issue, with placeholder values. check_query_plans() runs
+# explain() on each one and flags any whose winning plan scans the whole collection.
+_SAMPLE_MID = "__index_check__"
+_SAMPLE_TIME = datetime.datetime(2000, 1, 1)
+
+QUERY_SHAPES = [
+    {"name": "meter history", "collection": "meter_data",
+     "filter": {"MID": _SAMPLE_MID, "timestamp": {"$gte": _SAMPLE_TIME}},
+     "sort": [("timestamp", ASCENDING), ("_id", ASCENDING)]},
+    {"name": "meter history page", "collection": "meter_data",
+     "filter": {"MID": _SAMPLE_MID, "timestamp": {"$gte": _SAMPLE_TIME},
+                "$or": [{"timestamp": {"$gt": _SAMPLE_TIME}}, {"timestamp": _SAMPLE_TIME, "_id": {"$gt": ObjectId()}}]},
+     "sort": [("timestamp", ASCENDING), ("_id", ASCENDING)]},
+    {"name": "fleet latest readings", "collection": LATEST_COLLECTION,
+     "filter": {}, "sort": [("_id", ASCENDING)]},
+    {"name": "latest state upsert", "collection": LATEST_COLLECTION,
+     "filter": {"_id": _SAMPLE_MID, "timestamp": {"$lt": _SAMPLE_TIME}}},
+    {"name": "active alerts", "collection": LATEST_COLLECTION,
+     "filter": {"alert_active": True}, "sort": [("_id", ASCENDING)]},
+    {"name": "meter alert transitions", "collection": ALERTS_COLLECTION,
+     "filter": {"MID": _SAMPLE_MID}, "sort": [("timestamp", DESCENDING)]},
+    {"name": "metadata by MID", "collection": METADATA_COLLECTION,
+     "filter": {"MID": _SAMPLE_MID}},
+    {"name": "metadata page", "collection": METADATA_COLLECTION,
+     "filter": {"MID": {"$gt": _SAMPLE_MID}}, "sort": [("MID", ASCENDING)]},
+    {"name": "archive candidates", "collection": "meter_data",
+     "filter": {"MID": _SAMPLE_MID, "timestamp": {"$lt": _SAMPLE_TIME}},
+     "sort": [("timestamp", ASCENDING), ("_id", ASCENDING)]},
+    {"name": "fleet readings since", "collection": "meter_data",
+     "filter": {"timestamp": {"$gte": _SAMPLE_TIME, "$lt": _SAMPLE_TIME},
+                "$or": [{"timestamp": {"$gt": _SAMPLE_TIME}}, {"timestamp": _SAMPLE_TIME, "_id": {"$gt": ObjectId()}}]},
+     "sort": [("timestamp", ASCENDING), ("_id", ASCENDING)]},
+    {"name": "archived segments", "collection": ARCHIVE_SEGMENTS_COLLECTION,
+     "filter": {"MID": _SAMPLE_MID, "end": {"$gte": _SAMPLE_TIME}}, "sort": [("month", ASCENDING)]},
+] + [
+    {"name": f"{resolution} rollup history", "collection": collection_name,
+     "filter": {"MID": _SAMPLE_MID, "bucket": {"$gte": _SAMPLE_TIME}},
+     "sort": [("bucket", ASCENDING)]}
+    for resolution, collection_name in ROLLUP_COLLECTIONS.items()
+]
+
+
+def ensure_indexes(db):
+    """Creates the declared indexes. Safe to call repeatedly: existing indexes are left as-is."""
+    for collection_name, models in REQUIRED_INDEXES.items():
+        try:
+            created = db[collection_name].create_indexes(models)
+            logger.info(f"Indexes ensured on {collection_name}: {created}")
+        except errors.OperationFailure as e:
+            # e.g. an index with the same name but different keys/options already exists
+            logger.error(f"Could not create indexes on {collection_name}: {e}")
+
+
+def index_report(db):
+    """Returns {collection: {"missing": [...], "unused": [...], "undeclared": [...]}}.
+
+    "unused" lists indexes with no recorded accesses since the server last restarted
+    (from $indexStats), so it is only meaningful on a server that has seen real traffic.
+    """
+    report = {}
+    for collection_name, models in REQUIRED_INDEXES.items():
+        collection = db[collection_name]
+        declared = {model.document["name"] for model in models}
+        existing = set(collection.index_information())
+        unused = []
+        try:
+            for stats in collection.aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats.get("accesses", {}).get("ops", 0) == 0:
+                    unused.append(stats["name"])
+        except errors.OperationFailure as e:
+            logger.warning(f"$indexStats unavailable for {collection_name}: {e}")
+        report[collection_name] = {
+            "missing": sorted(declared - existing),
+            "unused": sorted(unused),
+            "undeclared": sorted(existing - declared - {"_id_"}),
+        }
+    return report
+
+
+def _plan_stages(plan):
+    """Yields every stage name in an explain() plan tree (classic and SBE layouts)."""
+    if not isinstance(plan, dict):
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan", "winningPlan"):
+        yield from _plan_stages(plan.get(key))
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+
+def check_query_plans(db):
+    """Runs explain() on every declared query shape.
+
+    Returns a list of (shape name, stages) for shapes whose winning plan contains a
+    COLLSCAN; an empty list means every endpoint query is served by an index.
+    """
+    failures = []
+    for shape in QUERY_SHAPES:
+        cursor = db[shape["collection"]].find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        winning_plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        stages = list(_plan_stages(winning_plan))
+        if "COLLSCAN" in stages:
+            logger.warning(f"Query shape '{shape['name']}' on {shape['collection']} uses a COLLSCAN: {stages}")
+            failures.append((shape["name"], stages))
+        else:
+            logger.info(f"Query shape '{shape['name']}' on {shape['collection']}: {stages}")
+    return failures
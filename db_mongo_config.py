@@ -1,12 +1,17 @@
 # db_mongo_config.py
 import os
-from pymongo import MongoClient, errors
+import threading
+from pymongo import MongoClient, errors, monitoring
 import logging
 
+from db_indexes import ensure_indexes
+from metrics import mongo_event_listeners
+
 logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
 
 MONGO_URI = os.environ.get("MONGO_URI")
-if not MONGO_URI:
+# Only optional when the app runs on the in-memory store (METER_STORE=memory, see meter_store.py)
+if not MONGO_URI and os.environ.get("METER_STORE", "mongo").lower() == "mongo":
     logger.critical("CRITICAL: MONGO_URI environment variable not set!")
     raise ValueError("CRITICAL: MONGO_URI environment variable not set!")
 
@@ -14,93 +19,168 @@ if not MONGO_URI:
 # If the database name is part of your MONGO_URI, this can be optional or used as a check.
 MONGO_DB_NAME_FROM_ENV = os.environ.get("MONGO_DB_NAME")
 
+# Create the declared indexes (see db_indexes.py) whenever a connection is established.
+# Idempotent; disable if indexes are managed separately (`flask --app app ensure-indexes`).
+MONGO_ENSURE_INDEXES = os.environ.get("MONGO_ENSURE_INDEXES", "true").lower() == "true"
+
+# --- Client Options ---
+# Pool sizes are per worker process. With gthread workers each thread may hold one
+# connection, so MONGO_MAX_POOL_SIZE should be at least the gunicorn thread count.
+# Timeouts are kept short so a cluster hiccup fails a request quickly instead of
+# stalling it; the driver keeps retrying server selection in the background.
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", "50")),
+    "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", "2")),
+    "maxIdleTimeMS": int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", "300000")),
+    "waitQueueTimeoutMS": int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+    "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    "socketTimeoutMS": int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", "30000")),
+    "retryWrites": True,
+}
+# Write concern; unset values fall back to the cluster default (majority on Atlas)
+if os.environ.get("MONGO_WRITE_CONCERN_W"):
+    _w = os.environ["MONGO_WRITE_CONCERN_W"]
+    MONGO_CLIENT_OPTIONS["w"] = int(_w) if _w.isdigit() else _w
+if os.environ.get("MONGO_WRITE_CONCERN_J"):
+    MONGO_CLIENT_OPTIONS["journal"] = os.environ["MONGO_WRITE_CONCERN_J"].lower() == "true"
+if os.environ.get("MONGO_WTIMEOUT_MS"):
+    MONGO_CLIENT_OPTIONS["wTimeoutMS"] = int(os.environ["MONGO_WTIMEOUT_MS"])
+
+
+# --- Liveness from Topology Events ---
+class TopologyMonitor(monitoring.TopologyListener):
+    """Tracks whether the driver currently sees a writable server.
+
+    Fed by the driver's background heartbeats, so checking liveness costs nothing on
+    the request path (no ping round trip).
+    """
+    def __init__(self):
+        self.writable = False
+
+    def opened(self, event):
+        logger.debug(f"MongoDB topology opened: {event.topology_id}")
+
+    def description_changed(self, event):
+        writable = event.new_description.has_writable_server()
+        if writable != self.writable:
+            if writable:
+                logger.info("MongoDB topology: writable server available.")
+            else:
+                logger.warning(f"MongoDB topology: no writable server ({event.new_description.topology_type_name}).")
+        self.writable = writable
+
+    def closed(self, event):
+        self.writable = False
+
+
+# One client per process. Clients must not be shared across fork(), so the owning pid
+# is recorded and a forked worker builds its own instead of reusing the parent's.
 client = None
 db_connection = None # This will store the database object
+topology_monitor = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _resolve_db_name(mongo_client):
+    # Option 1: Explicitly from MONGO_DB_NAME_FROM_ENV if provided
+    if MONGO_DB_NAME_FROM_ENV:
+        logger.info(f"Using database from MONGO_DB_NAME env var: {MONGO_DB_NAME_FROM_ENV}")
+        return MONGO_DB_NAME_FROM_ENV
+    # Option 2: Infer from URI (if URI has /dbname)
+    try:
+        inferred_db_name = mongo_client.get_database().name
+    except errors.ConfigurationError: # No default database in the URI
+        inferred_db_name = None
+    if inferred_db_name and inferred_db_name not in ['admin', 'local', 'config']: # 'admin', 'local', 'config' are system DBs
+        logger.info(f"Using database inferred from MONGO_URI: {inferred_db_name}")
+        return inferred_db_name
+    # Fallback if nothing specified and URI default is not a user database
+    # It's better to have the DB name in the URI or MONGO_DB_NAME env var
+    fallback_db_name = "WaterMeterData" # Choose a sensible default
+    logger.warning(f"MONGO_DB_NAME not set and no specific DB in URI, falling back to default: {fallback_db_name}")
+    return fallback_db_name
+
 
 def get_mongo_db_connection():
-    global client, db_connection
-    # Check if we already have a valid connection
-    if client and db_connection:
-        try:
-            client.admin.command('ping') # Check if server is available
-            logger.debug("MongoDB connection still active.")
+    """Returns this process's database object, creating the client on first use after fork.
+
+    MongoClient connects and reconnects in the background, so this never blocks on the
+    network; operations wait (up to serverSelectionTimeoutMS) only if no server is up.
+    """
+    global client, db_connection, topology_monitor, _client_pid
+    if db_connection is not None and _client_pid == os.getpid():
+        return db_connection
+
+    if not MONGO_URI:
+        raise errors.ConfigurationError("MONGO_URI environment variable not set.")
+
+    with _client_lock:
+        if db_connection is not None and _client_pid == os.getpid():
             return db_connection
-        except errors.ConnectionFailure:
-            logger.warning("MongoDB connection lost. Attempting to reconnect...")
-            client = None # Force re-connection
+        if _client_pid is not None and _client_pid != os.getpid():
+            # Inherited from the parent process: its sockets and monitor threads belong to the
+            # parent, so drop the references (closing would disturb the parent's pool).
+            logger.info(f"Discarding MongoDB client inherited from pid {_client_pid}.")
+            client = None
             db_connection = None
 
-    try:
-        # Log only a part of the URI for security, especially in production logs
-        uri_to_log = MONGO_URI.split('@')[-1] if '@' in MONGO_URI else MONGO_URI
-        logger.info(f"Attempting to connect to MongoDB cluster: ...@{uri_to_log}")
-        
-        # Increased timeout for initial connections, especially on services like Render
-        # that might have cold starts or network setup delays.
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=20000) 
-        
-        # The ping command will verify server availability and auth if db user requires it
-        client.admin.command('ping') 
-        logger.info("Successfully connected to MongoDB server (ping successful).")
-        
-        db_name_to_use = None
-        # Option 1: Explicitly from MONGO_DB_NAME_FROM_ENV if provided
-        if MONGO_DB_NAME_FROM_ENV:
-            db_name_to_use = MONGO_DB_NAME_FROM_ENV
-            logger.info(f"Using database from MONGO_DB_NAME env var: {db_name_to_use}")
-        # Option 2: Infer from URI (if URI has /dbname)
-        # MongoClient().get_database() gets the default DB from the URI.
-        # Its .name attribute gives the name of that database.
-        elif client.get_database().name and client.get_database().name not in ['admin', 'local', 'config']: # 'admin', 'local', 'config' are system DBs
-             inferred_db_name = client.get_database().name
-             db_name_to_use = inferred_db_name
-             logger.info(f"Using database inferred from MONGO_URI: {db_name_to_use}")
-        else:
-            # Fallback if nothing specified and URI default is not a user database
-            # It's better to have the DB name in the URI or MONGO_DB_NAME env var
-            fallback_db_name = "WaterMeterData" # Choose a sensible default
-            db_name_to_use = fallback_db_name
-            logger.warning(f"MONGO_DB_NAME not set and no specific DB in URI, falling back to default: {db_name_to_use}")
-        
-        if not db_name_to_use: # Should not happen with above logic, but as a safeguard
-            raise ValueError("Database name could not be determined. Set MONGO_DB_NAME or include it in MONGO_URI.")
-
-        db_connection = client[db_name_to_use] # Get the database object
-        logger.info(f"Connected to MongoDB database: {db_connection.name}")
-        return db_connection
-    except errors.ConfigurationError as e:
-        logger.critical(f"MongoDB Configuration Error (likely bad MONGO_URI format or invalid options): {e}", exc_info=True)
-        raise
-    except errors.OperationFailure as e: # This can catch authentication errors
-        logger.critical(f"MongoDB Operation Failure (often auth error - check user/pass in MONGO_URI, and DB user permissions): {e}", exc_info=True)
-        raise
-    except errors.ConnectionFailure as e: # This can catch network issues, server down, IP whitelist
-        logger.critical(f"MongoDB Connection Failure (check MONGO_URI, Atlas IP Access List, network, cluster status): {e}", exc_info=True)
-        raise
-    except Exception as e: # Catch-all for other unexpected errors during connection
-        logger.critical(f"An unexpected error occurred connecting to MongoDB: {e}", exc_info=True)
-        raise
+        try:
+            # Log only a part of the URI for security, especially in production logs
+            uri_to_log = MONGO_URI.split('@')[-1] if '@' in MONGO_URI else MONGO_URI
+            logger.info(f"Creating MongoDB client for cluster ...@{uri_to_log} (pid {os.getpid()})")
+
+            topology_monitor = TopologyMonitor()
+            new_client = MongoClient(MONGO_URI, event_listeners=[topology_monitor, *mongo_event_listeners()],
+                                     **MONGO_CLIENT_OPTIONS)
+            new_db = new_client[_resolve_db_name(new_client)] # Get the database object
+        except errors.ConfigurationError as e:
+            logger.critical(f"MongoDB Configuration Error (likely bad MONGO_URI format or invalid options): {e}", exc_info=True)
+            raise
+        except Exception as e: # Catch-all for other unexpected errors creating the client
+            logger.critical(f"An unexpected error occurred creating the MongoDB client: {e}", exc_info=True)
+            raise
+
+        client = new_client
+        db_connection = new_db
+        _client_pid = os.getpid()
+        logger.info(f"MongoDB client ready for database: {db_connection.name}")
+
+    if MONGO_ENSURE_INDEXES:
+        try:
+            ensure_indexes(db_connection)
+        except errors.PyMongoError as e: # Missing indexes slow queries down but must not block the connection
+            logger.error(f"Failed to ensure MongoDB indexes: {e}", exc_info=True)
+    return db_connection
+
 
 def get_db():
     """Returns the database connection, establishing it if necessary."""
-    global db_connection
-    if db_connection is None:
-        # Attempt to establish connection if not already established
-        # This also handles the case where an initial connection might have failed
-        # and we want to retry on the first actual use.
-        db_connection = get_mongo_db_connection()
-    else:
-        # Optionally, add a quick check if the existing connection is alive
-        # This adds overhead to every get_db() call.
-        # For simplicity here, we rely on the longer check in get_mongo_db_connection
-        # if a reconnect is needed.
-        pass
-    return db_connection
+    return get_mongo_db_connection()
+
+
+def is_connected():
+    """True while the driver sees a writable server (from topology events, no round trip)."""
+    return topology_monitor is not None and _client_pid == os.getpid() and topology_monitor.writable
+
 
-# Optional: You can try to establish the connection when the module is loaded.
-# If it fails, the app might not start, which can be good (fail-fast).
-# However, for serverless environments or retries, lazy connection in get_db() can be better.
-# try:
-#    get_mongo_db_connection() # Attempt initial connection
-# except Exception:
-#    pass # Logger in get_mongo_db_connection already handled it. App will fail on first get_db() if still bad.
\ No newline at end of file
+def warm_up():
+    """Creates this process's client and opens its first pooled connections.
+
+    Called from the gunicorn post_fork hook so the first requests a worker serves do
+    not pay for DNS, TLS and authentication. Failures are logged, not raised: the worker
+    still starts and the driver keeps connecting in the background.
+    """
+    if not MONGO_URI: # In-memory store; nothing to warm up
+        return
+    try:
+        db = get_mongo_db_connection()
+        db.command('ping') # Off the request path: establishes and authenticates a pooled connection
+        logger.info(f"MongoDB warm-up complete for pid {os.getpid()}.")
+    except errors.OperationFailure as e: # This can catch authentication errors
+        logger.critical(f"MongoDB Operation Failure during warm-up (often auth error - check user/pass in MONGO_URI, and DB user permissions): {e}", exc_info=True)
+    except errors.ConnectionFailure as e: # This can catch network issues, server down, IP whitelist
+        logger.error(f"MongoDB Connection Failure during warm-up (check MONGO_URI, Atlas IP Access List, network, cluster status): {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error during MongoDB warm-up: {e}", exc_info=True)
@@ -0,0 +1,56 @@
+# gunicorn.conf.py
+# Used by the Dockerfile and Procfile: gunicorn --config gunicorn.conf.py app:app
+import os
+import tempfile
+from dotenv import load_dotenv
+
+# Load .env in the master so every forked worker inherits the same environment
+load_dotenv()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# gthread workers serve several requests per process on threads. Requests mostly wait
+# on MongoDB, so threads add concurrency cheaply; workers add CPU parallelism.
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+# Recycle workers periodically (jittered so they don't all restart together)
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG") # e.g. "-" for stdout; off by default
+
+# Prometheus metrics (metrics.py) are written by each worker to files in this directory
+# and summed on scrape. Set in the master so every worker inherits it.
+if os.environ.get("METRICS_ENABLED", "true").lower() == "true" and not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="water-meter-metrics-")
+
+
+def on_starting(server):
+    # Files left by a previous run would be added to this run's counters
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith(".db"):
+                os.remove(os.path.join(directory, name))
+
+
+def post_fork(server, worker):
+    # Each worker builds its own MongoClient after fork and opens pooled connections
+    # before accepting requests. Imported here so the master never creates a client.
+    import db_mongo_config
+    db_mongo_config.warm_up()
+
+
+def child_exit(server, worker):
+    # Drops the exited worker's livesum gauges (e.g. open Mongo connections); its counters
+    # and histograms keep counting towards the totals
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,129 @@
+# history.py
+import base64
+import binascii
+import datetime
+import itertools
+import json
+import os
+from bson import ObjectId
+from bson.errors import InvalidId
+
+# Documents fetched per round trip while streaming a history cursor.
+HISTORY_BATCH_SIZE = int(os.environ.get("HISTORY_BATCH_SIZE", "2000"))
+# Largest page a client may request with `limit`.
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get("HISTORY_MAX_PAGE_SIZE", "10000"))
+# Serialized rows are joined into chunks of about this many bytes before being handed
+# to the WSGI server, instead of one write per row.
+STREAM_CHUNK_BYTES = 64 * 1024
+# Rows serialized by one json.dumps call (a call per row costs more than the encoding)
+STREAM_ROWS_PER_SLICE = 500
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+
+# --- Cursor Tokens ---
+# Opaque `after` tokens encode the (timestamp, _id) of the last row of a page. Paging
+# with them is a keyset seek on the (MID, timestamp) index rather than a skip/offset scan.
+
+def encode_cursor(timestamp, object_id):
+    millis = (timestamp - _EPOCH) // datetime.timedelta(milliseconds=1)
+    raw = f"{millis}:{object_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Returns (timestamp, ObjectId) for a token from encode_cursor; raises ValueError if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        millis, object_id = raw.split(":", 1)
+        return _EPOCH + datetime.timedelta(milliseconds=int(millis)), ObjectId(object_id)
+    except (binascii.Error, UnicodeDecodeError, InvalidId, ValueError) as e:
+        raise ValueError(f"Invalid cursor token: {token}") from e
+
+
+def keyset_filter(time_field, after):
+    """Query clause selecting rows strictly after the (timestamp, _id) position `after`."""
+    timestamp, object_id = after
+    return {"$or": [
+        {time_field: {"$gt": timestamp}},
+        {time_field: timestamp, "_id": {"$gt": object_id}},
+    ]}
+
+
+# --- Streaming Serialization ---
+
+def _format_row(doc):
+    row = {key: value for key, value in doc.items() if key != "_id"}
+    if isinstance(row.get("timestamp"), datetime.datetime):
+        row["timestamp"] = row["timestamp"].strftime('%Y-%m-%d %H:%M:%S UTC')
+    return row
+
+
+def _paged(docs, limit, state):
+    """Yields at most `limit` docs; leaves the next-page token in state["next_cursor"].
+
+    Callers fetch limit + 1 documents so that a following page can be detected.
+    """
+    count = 0
+    last = None
+    for doc in docs:
+        if limit is not None and count == limit:
+            # There is at least one more row: the page ends at the last one emitted.
+            state["next_cursor"] = encode_cursor(last["timestamp"], last["_id"])
+            return
+        yield doc
+        last = doc
+        count += 1
+
+
+def collect_page(docs, limit=None):
+    """Reads documents into a list; returns (docs, next_cursor) with the same paging as stream_rows."""
+    state = {"next_cursor": None}
+    return list(_paged(docs, limit, state)), state["next_cursor"]
+
+
+def _chunked(pieces):
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_BYTES:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def stream_rows(docs, output_format, limit=None):
+    """Serializes documents (which must carry _id and timestamp) as they are read.
+
+    output_format "json" produces a JSON array, or {"data": [...], "next_cursor": ...}
+    when a limit is given. "ndjson" produces one row per line, followed by a
+    {"next_cursor": ...} line when a limit is given. next_cursor is null on the last page.
+    """
+    state = {"next_cursor": None}
+    rows = (_format_row(doc) for doc in _paged(docs, limit, state))
+    slices = iter(lambda: list(itertools.islice(rows, STREAM_ROWS_PER_SLICE)), [])
+
+    def pieces():
+        if output_format == "ndjson":
+            for rows_slice in slices:
+                yield "".join(_ENCODER.encode(row) + "\n" for row in rows_slice)
+            if limit is not None:
+                yield json.dumps({"next_cursor": state["next_cursor"]}) + "\n"
+            return
+        yield '{"data":[' if limit is not None else "["
+        separator = ""
+        for rows_slice in slices:
+            # One array per slice, without its brackets
+            yield separator + _ENCODER.encode(rows_slice)[1:-1]
+            separator = ","
+        if limit is not None:
+            yield "]," + json.dumps({"next_cursor": state["next_cursor"]})[1:]
+        else:
+            yield "]"
+
+    return _chunked(pieces())
@@ -0,0 +1,51 @@
+# ingest.py
+import os
+import logging
+from pymongo import InsertOne, errors
+
+from alert_rules import annotate_readings, record_transitions
+from latest_state import LATEST_COLLECTION, get_latest_states, upsert_latest
+from mongo_utils import bulk_write_chunks
+from rollups import apply_rollups
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# Maximum number of documents sent in one bulk write. Keeps each round trip well
+# below MongoDB's message size limit and bounds the memory held per request.
+INSERT_CHUNK_SIZE = int(os.environ.get("INGEST_INSERT_CHUNK_SIZE", "1000"))
+
+def insert_readings(collection, readings, chunk_size=None):
+    """Writes readings with unordered bulk inserts of at most chunk_size documents.
+
+    Returns a list aligned with `readings`: None for every document that was written,
+    or an error message for every document the database did not accept or that cannot
+    be encoded as BSON (starting with DATABASE_UNAVAILABLE if the server was unreachable).
+    """
+    write_errors, _ = bulk_write_chunks(collection, readings, InsertOne, chunk_size or INSERT_CHUNK_SIZE)
+    return [error and error.get("errmsg", "Write error") for error in write_errors]
+
+
+def store_readings(db, readings):
+    """Inserts readings into meter_data and refreshes the derived per-meter state.
+
+    Alert rules are evaluated once here and stored on each reading. Returns the per-item
+    error list of insert_readings. Derived state is updated only for readings that were
+    written; a failure there is logged rather than reported against readings that are
+    already stored (the rebuild commands repair it).
+    """
+    annotate_readings(readings)
+    results = insert_readings(db["meter_data"], readings)
+    written = [doc for doc, error in zip(readings, results) if error is None]
+    if written:
+        try:
+            # Alert transitions compare against the state from before this batch
+            previous_states = get_latest_states(db, {doc["MID"] for doc in written})
+            upsert_latest(db, written)
+            record_transitions(db, written, previous_states)
+        except errors.PyMongoError as e:
+            logger.error(f"MongoDB error updating {LATEST_COLLECTION} for {len(written)} readings: {e}", exc_info=True)
+        try:
+            apply_rollups(db, written)
+        except errors.PyMongoError as e:
+            logger.error(f"MongoDB error updating rollups for {len(written)} readings: {e}", exc_info=True)
+    return results
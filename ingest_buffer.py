@@ -0,0 +1,332 @@
+# ingest_buffer.py
+import atexit
+import collections
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+import bson
+from pymongo import errors
+
+from mongo_utils import DATABASE_UNAVAILABLE, is_retryable
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# --- Write-Behind Settings ---
+# When enabled, submit endpoints answer 202 as soon as readings are queued; a background
+# thread per worker writes them to MongoDB in batches.
+INGEST_WRITE_BEHIND = os.environ.get("INGEST_WRITE_BEHIND", "false").lower() == "true"
+INGEST_QUEUE_MAX = int(os.environ.get("INGEST_QUEUE_MAX", "20000"))
+INGEST_FLUSH_BATCH = int(os.environ.get("INGEST_FLUSH_BATCH", "1000"))
+INGEST_FLUSH_INTERVAL_S = float(os.environ.get("INGEST_FLUSH_INTERVAL_S", "1.0"))
+INGEST_SPOOL_DIR = os.environ.get("INGEST_SPOOL_DIR", "ingest_spool")
+INGEST_SPOOL_MAX_BYTES = int(os.environ.get("INGEST_SPOOL_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Spool records: 4-byte big-endian length followed by one BSON-encoded reading
+_RECORD_HEADER = struct.Struct(">I")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_spool(path):
+    """Yields the readings stored in a spool file, in the order they were appended.
+
+    A truncated final record (a crash mid-append) is logged and skipped.
+    """
+    with open(path, "rb") as spool_file:
+        while True:
+            header = spool_file.read(_RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < _RECORD_HEADER.size:
+                logger.warning(f"Truncated record header at end of spool {path}; ignoring it.")
+                return
+            (length,) = _RECORD_HEADER.unpack(header)
+            data = spool_file.read(length)
+            if len(data) < length:
+                logger.warning(f"Truncated record at end of spool {path}; ignoring it.")
+                return
+            yield bson.decode(data)
+
+
+class IngestBuffer:
+    """Bounded in-process queue of readings, drained by a background flusher thread.
+
+    `write(readings)` stores a batch and returns per-item errors (None = written), as
+    ingest.store_readings does; `is_connected()` reports database availability. Readings
+    whose error is retryable (mongo_utils.is_retryable), and drained batches while the database
+    is unavailable, are appended to a local spool file, which is replayed in order before
+    any newer readings once the connection comes back. Other errors are final: those
+    readings are counted in write_errors and dropped.
+    """
+
+    def __init__(self, write, is_connected, queue_max=INGEST_QUEUE_MAX, flush_batch=INGEST_FLUSH_BATCH,
+                 flush_interval=INGEST_FLUSH_INTERVAL_S, spool_dir=INGEST_SPOOL_DIR,
+                 spool_max_bytes=INGEST_SPOOL_MAX_BYTES):
+        self.write = write
+        self.is_connected = is_connected
+        self.queue_max = queue_max
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir
+        self.spool_max_bytes = spool_max_bytes
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._owner_pid = None
+        self._stopping = False
+        self._counters = collections.Counter()
+        self._flush_seconds_total = 0.0
+        self._flush_seconds_max = 0.0
+        self._last_flush_seconds = None
+
+    # --- Producer Side ---
+
+    def offer(self, readings):
+        """Queues all of `readings` or none of them. Returns False when the queue is full."""
+        self._ensure_started()
+        with self._cond:
+            if len(self._queue) + len(readings) > self.queue_max:
+                self._counters["rejected_full"] += len(readings)
+                return False
+            self._queue.extend(readings)
+            self._counters["accepted"] += len(readings)
+            if len(self._queue) >= self.flush_batch:
+                self._cond.notify()
+        return True
+
+    def stats(self):
+        spool_bytes, spool_files = self._spool_usage()
+        flushes = self._counters["flushes"]
+        with self._cond:
+            depth = len(self._queue)
+        return {
+            "enabled": True,
+            "queue_depth": depth,
+            "queue_max": self.queue_max,
+            "accepted": self._counters["accepted"],
+            "rejected_full": self._counters["rejected_full"],
+            "written": self._counters["written"],
+            "write_errors": self._counters["write_errors"],
+            "spooled": self._counters["spooled"],
+            "replayed": self._counters["replayed"],
+            "flushes": flushes,
+            "flush_latency_last_ms": round(self._last_flush_seconds * 1000, 1) if self._last_flush_seconds is not None else None,
+            "flush_latency_avg_ms": round(self._flush_seconds_total / flushes * 1000, 1) if flushes else None,
+            "flush_latency_max_ms": round(self._flush_seconds_max * 1000, 1),
+            "spool_bytes": spool_bytes,
+            "spool_files": spool_files,
+        }
+
+    # --- Flusher Thread ---
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so each gunicorn worker starts its own flusher
+        if self._thread is not None and self._owner_pid == os.getpid():
+            return
+        with self._cond:
+            if self._thread is not None and self._owner_pid == os.getpid():
+                return
+            self._queue.clear() # Anything inherited from the parent is the parent's to flush
+            self._stopping = False
+            self._owner_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        logger.info(f"Ingest write-behind flusher started (pid {self._owner_pid}).")
+
+    def stop(self, timeout=10.0):
+        """Stops the flusher after a final drain (to MongoDB or, failing that, the spool)."""
+        if self._thread is None or self._owner_pid != os.getpid():
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _take_batch(self):
+        with self._cond:
+            if len(self._queue) < self.flush_batch and not self._stopping:
+                self._cond.wait(self.flush_interval)
+            batch = []
+            while self._queue and len(batch) < self.flush_batch:
+                batch.append(self._queue.popleft())
+            return batch, self._stopping and not self._queue
+
+    def _requeue_front(self, batch):
+        with self._cond:
+            self._queue.extendleft(reversed(batch))
+
+    def _run(self):
+        while True:
+            batch, last = self._take_batch()
+            try:
+                if self._spool_paths() and self.is_connected():
+                    self._replay_spools()
+                if batch:
+                    self._flush(batch)
+            except Exception as e: # Never let the flusher die (spool I/O); readings stay queued or spooled
+                logger.error(f"Ingest flusher error: {e}", exc_info=True)
+                if batch:
+                    self._requeue_front(batch)
+                time.sleep(self.flush_interval)
+            if last:
+                return
+
+    def _flush(self, batch):
+        # Readings must reach MongoDB in arrival order: while older ones are spooled,
+        # newer ones go to the spool behind them.
+        if self._owned_spool_size() or not self.is_connected():
+            self._spool_or_requeue(batch)
+            return
+
+        started = time.monotonic()
+        results = self._write(batch)
+        elapsed = time.monotonic() - started
+        self._counters["flushes"] += 1
+        self._flush_seconds_total += elapsed
+        self._flush_seconds_max = max(self._flush_seconds_max, elapsed)
+        self._last_flush_seconds = elapsed
+
+        retry = [doc for doc, error in zip(batch, results) if is_retryable(error)]
+        failed = [error for error in results if error and not is_retryable(error)]
+        self._counters["written"] += len(batch) - len(retry) - len(failed)
+        if retry:
+            # Lost the connection mid-write. Readings that did land keep their _id, so a
+            # replay of them is rejected as a duplicate rather than stored twice.
+            self._spool_or_requeue(retry)
+        if failed:
+            self._counters["write_errors"] += len(failed)
+            logger.error(f"Ingest flusher: {len(failed)} of {len(batch)} readings rejected: {failed[0]}")
+
+    def _write(self, batch):
+        """Calls write(batch), turning exceptions into per-item errors.
+
+        A connection failure is retryable for the whole batch. Any other exception is
+        assumed to come from some of the readings: the batch is split and written in
+        halves until the readings that raise are isolated and fail on their own.
+        """
+        try:
+            return self.write(batch)
+        except errors.ConnectionFailure as e:
+            return [f"{DATABASE_UNAVAILABLE}: {e}"] * len(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error(f"Ingest flusher: could not write reading for MID {batch[0].get('MID')}: {e}",
+                             exc_info=True)
+                return [f"Write error: {e}"]
+        middle = len(batch) // 2
+        return self._write(batch[:middle]) + self._write(batch[middle:])
+
+    # --- Spool ---
+
+    def _own_spool_path(self):
+        return os.path.join(self.spool_dir, f"ingest-{os.getpid()}.spool")
+
+    @staticmethod
+    def _spool_owner(path):
+        # ingest-<pid>.spool, or ingest-<pid>-<original pid>.spool once adopted from an exited worker
+        try:
+            return int(os.path.basename(path)[len("ingest-"):-len(".spool")].split("-")[0])
+        except ValueError:
+            return None
+
+    def _owned_spool_size(self):
+        total = 0
+        for path in self._spool_paths():
+            if self._spool_owner(path) == os.getpid():
+                try:
+                    total += os.path.getsize(path)
+                except OSError:
+                    pass
+        return total
+
+    def _spool_paths(self):
+        return sorted(glob.glob(os.path.join(self.spool_dir, "ingest-*.spool")))
+
+    def _spool_usage(self):
+        paths = self._spool_paths()
+        total = 0
+        for path in paths:
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total, len(paths)
+
+    def _spool_or_requeue(self, batch):
+        if self._spool_usage()[0] >= self.spool_max_bytes:
+            # Spool is full too: keep the readings in memory; the queue filling up is what
+            # turns into 429s for the gateway.
+            logger.warning(f"Ingest spool full ({self.spool_max_bytes} bytes); holding {len(batch)} readings in memory.")
+            self._requeue_front(batch)
+            time.sleep(self.flush_interval)
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with open(self._own_spool_path(), "ab") as spool_file:
+            for doc in batch:
+                data = bson.encode(doc)
+                spool_file.write(_RECORD_HEADER.pack(len(data)))
+                spool_file.write(data)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        self._counters["spooled"] += len(batch)
+        logger.warning(f"MongoDB unavailable: spooled {len(batch)} readings to {self._own_spool_path()}.")
+
+    def _replay_spools(self):
+        """Replays this worker's spools and any left behind by workers that have exited."""
+        for path in self._spool_paths():
+            owner = self._spool_owner(path)
+            if owner is None:
+                continue
+            if owner != os.getpid():
+                if _pid_alive(owner):
+                    continue # Still being written by a live worker
+                # Adopt the orphan with an atomic rename so only one worker replays it
+                adopted = os.path.join(self.spool_dir, f"ingest-{os.getpid()}-{owner}.spool")
+                try:
+                    os.rename(path, adopted)
+                except OSError:
+                    continue
+                path = adopted
+            if not self._replay_file(path):
+                return
+
+    def _replay_file(self, path):
+        """Writes a spool file's readings in order. Returns True once the file is fully replayed."""
+        records = list(read_spool(path))
+        logger.info(f"Replaying {len(records)} spooled readings from {path}.")
+        for start in range(0, len(records), self.flush_batch):
+            chunk = records[start:start + self.flush_batch]
+            results = self._write(chunk)
+            retry = [doc for doc, error in zip(chunk, results) if is_retryable(error)]
+            self._counters["replayed"] += sum(1 for error in results if not error)
+            self._counters["write_errors"] += sum(1 for error in results if error and not is_retryable(error))
+            if retry:
+                # Connection dropped again: keep the unwritten readings and everything after them
+                self._rewrite_spool(path, retry + records[start + len(chunk):])
+                return False
+        os.remove(path)
+        return True
+
+    def _rewrite_spool(self, path, records):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as spool_file:
+            for doc in records:
+                data = bson.encode(doc)
+                spool_file.write(_RECORD_HEADER.pack(len(data)))
+                spool_file.write(data)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.replace(tmp_path, path)
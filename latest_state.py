@@ -0,0 +1,79 @@
+# latest_state.py
+import logging
+from pymongo import UpdateOne, errors
+
+from mongo_utils import DUPLICATE_KEY_ERROR
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# One document per meter, keyed by MID (_id), holding its newest reading.
+LATEST_COLLECTION = "meters_latest"
+LATEST_FIELDS = ("MID", "WH", "timestamp", "status_code", "battery_vol", "network", "alerts", "alert_status")
+
+
+def latest_by_mid(readings):
+    """Reduces readings to the newest one per MID (later entries win timestamp ties)."""
+    latest = {}
+    for doc in readings:
+        current = latest.get(doc["MID"])
+        if current is None or doc["timestamp"] >= current["timestamp"]:
+            latest[doc["MID"]] = doc
+    return latest
+
+
+def get_latest_states(db, mids):
+    """Returns {MID: {"alerts", "timestamp"}} for the meters that already have a state."""
+    cursor = db[LATEST_COLLECTION].find({"_id": {"$in": list(mids)}}, {"alerts": 1, "timestamp": 1})
+    return {doc["_id"]: doc for doc in cursor}
+
+
+def upsert_latest(db, readings):
+    """Records the newest of `readings` per meter in meters_latest.
+
+    Each upsert only matches a stored state that is older than the reading, so a
+    late-arriving reading never overwrites a newer one. When a newer state exists the
+    filter matches nothing and the upsert's insert collides on _id; those duplicate key
+    errors are the expected "already newer" outcome and are ignored.
+    """
+    operations = []
+    for mid, doc in latest_by_mid(readings).items():
+        state = {field: doc[field] for field in LATEST_FIELDS if field in doc}
+        state["alert_active"] = bool(doc.get("alerts")) # Indexed (partial) for the active alerts query
+        operations.append(UpdateOne({"_id": mid, "timestamp": {"$lt": doc["timestamp"]}},
+                                    {"$set": state}, upsert=True))
+    if not operations:
+        return
+    try:
+        db[LATEST_COLLECTION].bulk_write(operations, ordered=False)
+    except errors.BulkWriteError as e:
+        unexpected = [err for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY_ERROR]
+        if unexpected:
+            raise
+
+
+def rebuild_latest(db):
+    """Regenerates meters_latest from the full meter_data history (backfill and repair).
+
+    Merges rather than replaces, with the same newest-wins rule as upsert_latest, so
+    readings ingested while the rebuild runs are never rolled back.
+    """
+    pipeline = [
+        {"$sort": {"MID": 1, "timestamp": -1}},
+        {"$group": {"_id": "$MID", "latest_doc": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+            {field: f"$latest_doc.{field}" for field in LATEST_FIELDS},
+            {"_id": "$_id",
+             "alert_active": {"$gt": [{"$size": {"$ifNull": ["$latest_doc.alerts", []]}}, 0]}},
+        ]}}},
+        {"$merge": {
+            "into": LATEST_COLLECTION,
+            "on": "_id",
+            "whenMatched": [{"$replaceWith": {"$cond": [
+                {"$gte": ["$$new.timestamp", "$timestamp"]}, "$$new", "$$ROOT"]}}],
+            "whenNotMatched": "insert",
+        }},
+    ]
+    db["meter_data"].aggregate(pipeline, allowDiskUse=True)
+    count = db[LATEST_COLLECTION].count_documents({})
+    logger.info(f"Rebuilt {LATEST_COLLECTION}: {count} meters.")
+    return count
@@ -0,0 +1,159 @@
+# meter_metadata.py
+import logging
+import os
+import threading
+import time
+from pymongo import ASCENDING, InsertOne, ReturnDocument, UpdateOne, errors
+
+from latest_state import LATEST_FIELDS
+from mongo_utils import DUPLICATE_KEY_ERROR, ChangeStreamWatcher, bulk_write_chunks
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# One document per meter with free-form descriptive fields (location, customer, ...).
+# The unique MID_1 index (db_indexes.py) is what makes a second document for a MID a
+# conflict, for single creates and bulk imports alike.
+METADATA_COLLECTION = "meters_metadata"
+
+# Set by the API on every write; clients cannot set these
+METADATA_MANAGED_FIELDS = ("_id", "LastModified")
+
+# Largest bulk import accepted in one request, and documents per bulk_write round trip
+METADATA_BULK_MAX_ITEMS = int(os.environ.get("METADATA_BULK_MAX_ITEMS", "10000"))
+METADATA_WRITE_CHUNK_SIZE = int(os.environ.get("METADATA_WRITE_CHUNK_SIZE", "1000"))
+
+# --- Enrichment Cache Settings ---
+# Metadata fields copied into every /api/meters entry, from a per-worker cache that is
+# reloaded after this worker writes metadata, after METADATA_CACHE_TTL_S, and on every
+# change from any writer with METADATA_CACHE_CHANGE_STREAM=true (needs a replica set).
+METADATA_ENRICH_FIELDS = tuple(field.strip() for field in os.environ.get(
+    "METADATA_ENRICH_FIELDS", "Location,CustomerName,CustomerID").split(",") if field.strip())
+METADATA_CACHE_TTL_S = float(os.environ.get("METADATA_CACHE_TTL_S", "60"))
+METADATA_CACHE_CHANGE_STREAM = os.environ.get("METADATA_CACHE_CHANGE_STREAM", "false").lower() == "true"
+
+if set(METADATA_ENRICH_FIELDS) & set(LATEST_FIELDS):
+    raise ValueError(f"METADATA_ENRICH_FIELDS must not contain reading fields: "
+                     f"{sorted(set(METADATA_ENRICH_FIELDS) & set(LATEST_FIELDS))}")
+
+
+# --- Collection Helpers ---
+
+def create_metadata(db, doc):
+    """Inserts a meter's metadata in one round trip. Returns the document, or None if the MID exists."""
+    try:
+        db[METADATA_COLLECTION].insert_one(doc) # Sets doc["_id"]
+    except errors.DuplicateKeyError:
+        return None
+    return doc
+
+
+def find_metadata(db, mid):
+    return db[METADATA_COLLECTION].find_one({"MID": mid})
+
+
+def list_metadata(db, fields=None, after=None, limit=None):
+    """Metadata documents ordered by MID, optionally only `fields` and only MIDs after `after`."""
+    query = {"MID": {"$gt": after}} if after is not None else {}
+    projection = {"_id": 0, "MID": 1, **{field: 1 for field in fields}} if fields is not None else None
+    cursor = db[METADATA_COLLECTION].find(query, projection).sort("MID", ASCENDING)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return list(cursor)
+
+
+def update_metadata(db, mid, fields):
+    """Sets `fields` on a meter's metadata. Returns the updated document, or None if there is none."""
+    return db[METADATA_COLLECTION].find_one_and_update({"MID": mid}, {"$set": fields},
+                                                        return_document=ReturnDocument.AFTER)
+
+
+def delete_metadata(db, mid):
+    return db[METADATA_COLLECTION].delete_one({"MID": mid}).deleted_count > 0
+
+
+def write_metadata_bulk(db, docs, upsert=False, chunk_size=None):
+    """Writes many meters' metadata with unordered bulk_write calls (see mongo_utils.bulk_write_chunks).
+
+    Without `upsert` every document is inserted and an existing MID is a conflict; with it,
+    existing documents get the given fields set. Returns a list aligned with `docs` of
+    (status, error) pairs, status being "created", "updated", "conflict" or "failed".
+    """
+    if upsert:
+        make_operation = lambda doc: UpdateOne({"MID": doc["MID"]}, {"$set": doc}, upsert=True)
+    else:
+        make_operation = InsertOne
+    write_errors, upserted = bulk_write_chunks(db[METADATA_COLLECTION], docs, make_operation,
+                                               chunk_size or METADATA_WRITE_CHUNK_SIZE)
+    results = []
+    for i, (doc, error) in enumerate(zip(docs, write_errors)):
+        if error is None:
+            results.append(("created" if not upsert or i in upserted else "updated", None))
+        elif error.get("code") == DUPLICATE_KEY_ERROR:
+            # Inserts: the MID exists. Upserts: a concurrent writer created it first.
+            results.append(("conflict", f"Meter metadata with MID {doc['MID']} already exists."))
+        else:
+            results.append(("failed", error.get("errmsg", "Write error")))
+    return results
+
+
+# --- Enrichment Cache ---
+
+class MetadataCache:
+    """Per-worker map of MID -> METADATA_ENRICH_FIELDS, loaded with one query.
+
+    Serves /api/meters without a $lookup or a query per meter. A failed reload keeps
+    serving the previous map.
+    """
+
+    def __init__(self, load, ttl=METADATA_CACHE_TTL_S):
+        self._load = load # Returns documents with MID and the enrichment fields
+        self.ttl = ttl
+        self._entries = None
+        self._loaded_at = None
+        self._loaded_version = None
+        self._version = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock() # One reload at a time; not held by invalidate()
+        self._counters = {"loads": 0, "load_errors": 0, "invalidations": 0}
+        self._watcher = ChangeStreamWatcher("metadata-cache-watcher", self.invalidate)
+
+    def invalidate(self):
+        """Marks the map stale (after this worker writes metadata, or on a change event)."""
+        with self._lock:
+            self._version += 1
+            self._counters["invalidations"] += 1
+
+    def _is_fresh(self):
+        return (self._entries is not None and self._loaded_version == self._version
+                and time.monotonic() - self._loaded_at < self.ttl)
+
+    def get_all(self):
+        if self._is_fresh():
+            return self._entries
+        with self._load_lock:
+            if self._is_fresh(): # Another thread reloaded it meanwhile
+                return self._entries
+            version = self._version # Read before loading: later writes invalidate this load
+            try:
+                docs = self._load()
+            except errors.PyMongoError as e:
+                self._counters["load_errors"] += 1
+                logger.warning(f"Could not reload meter metadata, serving the previous copy: {e}")
+                return self._entries or {}
+            self._entries = {doc["MID"]: {field: doc.get(field) for field in METADATA_ENRICH_FIELDS}
+                             for doc in docs}
+            self._loaded_at = time.monotonic()
+            self._loaded_version = version
+            self._counters["loads"] += 1
+            return self._entries
+
+    def stats(self):
+        return {
+            "meters": len(self._entries) if self._entries is not None else 0,
+            "fields": list(METADATA_ENRICH_FIELDS),
+            **self._counters,
+        }
+
+    def start_change_stream(self, get_db):
+        """Invalidates the map on every change to meters_metadata (see ChangeStreamWatcher)."""
+        self._watcher.start(get_db, [METADATA_COLLECTION])
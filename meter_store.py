@@ -0,0 +1,356 @@
+# meter_store.py
+import abc
+import bisect
+import heapq
+import logging
+import os
+import threading
+from bson import ObjectId
+from pymongo import ASCENDING, errors
+
+from archive import archived_segments, iter_archived, merge_history
+from alert_rules import alert_transitions, annotate_readings, find_active_alerts, find_alert_transitions
+from history import keyset_filter
+from ingest import store_readings
+from latest_state import LATEST_COLLECTION, LATEST_FIELDS, latest_by_mid
+from meter_metadata import (create_metadata, delete_metadata, find_metadata, list_metadata, update_metadata,
+                            write_metadata_bulk)
+from mongo_utils import DATABASE_UNAVAILABLE
+from rollups import ROLLUP_COLLECTIONS, bucket_increments, bucket_start, find_rollups, rollup_row
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# Which MeterStore the app uses: "mongo" (default) or "memory" (process-local, for
+# benchmarks and local profiling without a cluster; nothing is persisted).
+METER_STORE = os.environ.get("METER_STORE", "mongo").lower()
+
+# Fields returned by list_latest and iter_history
+LATEST_OUTPUT_FIELDS = ("MID", "WH", "timestamp", "status_code", "battery_vol", "network", "alerts", "alert_status")
+HISTORY_FIELDS = ("_id", "timestamp", "WH", "battery_vol", "network", "status_code")
+FLEET_READING_FIELDS = ("_id", "MID", "timestamp", "WH")
+ACTIVE_ALERT_FIELDS = ("MID", "timestamp", "alerts", "alert_status", "status_code", "battery_vol", "network", "WH")
+
+
+class MeterStore(abc.ABC):
+    """Storage operations behind the API endpoints.
+
+    Readers return plain dicts with naive UTC datetimes, as pymongo does; callers may
+    modify them. Readings passed to store_readings gain an _id and their alert fields.
+    """
+
+    @abc.abstractmethod
+    def store_readings(self, readings):
+        """Stores readings and their derived state; returns per-item errors (None = stored)."""
+
+    @abc.abstractmethod
+    def is_available(self):
+        """True if writes are currently expected to succeed (cheap; no round trip)."""
+
+    @abc.abstractmethod
+    def list_latest(self):
+        """Latest state of every meter, ordered by MID."""
+
+    @abc.abstractmethod
+    def iter_history(self, meter_id, start_date, after=None, limit=None, batch_size=None):
+        """Raw readings from start_date on, ordered by (timestamp, _id), strictly after `after`."""
+
+    @abc.abstractmethod
+    def iter_fleet_readings(self, start_date, until, after=None, batch_size=None):
+        """Every meter's readings in [start_date, until) as FLEET_READING_FIELDS, ordered by (timestamp, _id)."""
+
+    @abc.abstractmethod
+    def iter_rollups(self, meter_id, start_date, resolution, after=None, limit=None, batch_size=None):
+        """Hourly or daily buckets as rollups.rollup_row rows, oldest first."""
+
+    @abc.abstractmethod
+    def find_active_alerts(self):
+        """Latest state (ACTIVE_ALERT_FIELDS) of every meter with an active alert, ordered by MID."""
+
+    @abc.abstractmethod
+    def find_alert_transitions(self, meter_id, limit=100):
+        """A meter's most recent alert transitions, newest first."""
+
+    @abc.abstractmethod
+    def create_metadata(self, doc):
+        """Inserts a meter's metadata. Returns the stored document, or None if the MID exists."""
+
+    @abc.abstractmethod
+    def find_metadata(self, mid):
+        """A meter's metadata document, or None if it has none."""
+
+    @abc.abstractmethod
+    def list_metadata(self, fields=None, after=None, limit=None):
+        """Metadata documents ordered by MID (only MID and `fields` if given), MIDs after `after`."""
+
+    @abc.abstractmethod
+    def update_metadata(self, mid, fields):
+        """Sets fields on a meter's metadata; returns the updated document, or None if there is none."""
+
+    @abc.abstractmethod
+    def delete_metadata(self, mid):
+        """Deletes a meter's metadata; returns True if it had any."""
+
+    @abc.abstractmethod
+    def write_metadata(self, docs, upsert=False):
+        """Bulk insert (or upsert) of metadata; per-document (status, error) as meter_metadata.write_metadata_bulk."""
+
+
+class MongoMeterStore(MeterStore):
+    """MeterStore on the MongoDB collections (see ingest.py, latest_state.py, rollups.py)."""
+
+    def __init__(self, get_db, is_connected):
+        # Callables rather than a database object: the client is created per worker after fork
+        self._get_db = get_db
+        self._is_connected = is_connected
+
+    def store_readings(self, readings):
+        try:
+            db = self._get_db()
+        except errors.PyMongoError as e: # Creating the client failed (e.g. DNS for a mongodb+srv URI)
+            return [f"{DATABASE_UNAVAILABLE}: {e}"] * len(readings)
+        return store_readings(db, readings)
+
+    def is_available(self):
+        # The topology flag stays False until this worker's client exists, and the write-behind
+        # path may be the first to need it; once created this is a cheap check.
+        try:
+            self._get_db()
+        except errors.PyMongoError:
+            return False
+        return self._is_connected()
+
+    def list_latest(self):
+        projection = {"_id": 0, **{field: 1 for field in LATEST_OUTPUT_FIELDS}}
+        # _id is the MID, so this sort walks the _id index
+        return list(self._get_db()[LATEST_COLLECTION].find({}, projection).sort("_id", ASCENDING))
+
+    def iter_history(self, meter_id, start_date, after=None, limit=None, batch_size=None):
+        query = {"MID": meter_id, "timestamp": {"$gte": start_date}}
+        if after is not None:
+            query.update(keyset_filter("timestamp", after))
+        # Sort ascending by time; _id orders readings that share a timestamp
+        cursor = self._get_db()["meter_data"].find(query, {field: 1 for field in HISTORY_FIELDS}).sort(
+            [("timestamp", ASCENDING), ("_id", ASCENDING)])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        # Readings past the retention window live in archive segments (archive.py)
+        segments = archived_segments(self._get_db(), meter_id, start_date, after)
+        if not segments:
+            return cursor
+        return merge_history(iter_archived(segments, start_date, after), cursor, limit=limit)
+
+    def iter_fleet_readings(self, start_date, until, after=None, batch_size=None):
+        query = {"timestamp": {"$gte": start_date, "$lt": until}}
+        if after is not None:
+            query.update(keyset_filter("timestamp", after))
+        # Served by the (timestamp, _id) index, so incremental reads start at `after`
+        cursor = self._get_db()["meter_data"].find(query, {field: 1 for field in FLEET_READING_FIELDS}).sort(
+            [("timestamp", ASCENDING), ("_id", ASCENDING)])
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    def iter_rollups(self, meter_id, start_date, resolution, after=None, limit=None, batch_size=None):
+        return find_rollups(self._get_db(), meter_id, start_date, resolution,
+                            after=after, limit=limit, batch_size=batch_size)
+
+    def find_active_alerts(self):
+        return find_active_alerts(self._get_db())
+
+    def find_alert_transitions(self, meter_id, limit=100):
+        return find_alert_transitions(self._get_db(), meter_id, limit=limit)
+
+    def create_metadata(self, doc):
+        return create_metadata(self._get_db(), doc)
+
+    def find_metadata(self, mid):
+        return find_metadata(self._get_db(), mid)
+
+    def list_metadata(self, fields=None, after=None, limit=None):
+        return list_metadata(self._get_db(), fields=fields, after=after, limit=limit)
+
+    def update_metadata(self, mid, fields):
+        return update_metadata(self._get_db(), mid, fields)
+
+    def delete_metadata(self, mid):
+        return delete_metadata(self._get_db(), mid)
+
+    def write_metadata(self, docs, upsert=False):
+        return write_metadata_bulk(self._get_db(), docs, upsert=upsert)
+
+
+class MemoryMeterStore(MeterStore):
+    """Process-local MeterStore with readings indexed by MID and (timestamp, _id).
+
+    Applies the same alert, latest-state and rollup rules as the Mongo path, so request
+    handling can be benchmarked and profiled without a cluster. Not shared between
+    gunicorn workers and not persisted.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reading_keys = {} # MID -> sorted [(timestamp, _id)]
+        self._readings = {} # MID -> documents, parallel to _reading_keys[MID]
+        self._latest = {} # MID -> latest state
+        self._rollups = {resolution: {} for resolution in ROLLUP_COLLECTIONS} # resolution -> MID -> {bucket: doc}
+        self._transitions = {} # MID -> [transition, ...] oldest first
+        self._metadata = {} # MID -> document
+
+    def store_readings(self, readings):
+        annotate_readings(readings)
+        with self._lock:
+            mids = {doc["MID"] for doc in readings}
+            previous_states = {mid: self._latest[mid] for mid in mids if mid in self._latest}
+            for doc in readings:
+                doc.setdefault("_id", ObjectId())
+                # BSON dates have millisecond precision; match it so cursor tokens round-trip
+                doc["timestamp"] = doc["timestamp"].replace(microsecond=doc["timestamp"].microsecond // 1000 * 1000)
+                keys = self._reading_keys.setdefault(doc["MID"], [])
+                key = (doc["timestamp"], doc["_id"])
+                position = bisect.bisect_right(keys, key) # == len(keys) for in-order arrivals
+                keys.insert(position, key)
+                self._readings.setdefault(doc["MID"], []).insert(position, doc)
+
+            for mid, doc in latest_by_mid(readings).items():
+                current = self._latest.get(mid)
+                if current is None or current["timestamp"] < doc["timestamp"]:
+                    state = {field: doc[field] for field in LATEST_FIELDS if field in doc}
+                    state["alert_active"] = bool(doc.get("alerts"))
+                    self._latest[mid] = state
+
+            for transition in alert_transitions(readings, previous_states):
+                self._transitions.setdefault(transition["MID"], []).append(transition)
+
+            for resolution in ROLLUP_COLLECTIONS:
+                for (mid, bucket), inc in bucket_increments(readings, resolution).items():
+                    buckets = self._rollups[resolution].setdefault(mid, {})
+                    stored = buckets.get(bucket)
+                    if stored is None:
+                        buckets[bucket] = {"_id": ObjectId(), "MID": mid, "bucket": bucket, **inc}
+                        continue
+                    stored["count"] += inc["count"]
+                    stored["battery_vol_sum"] += inc["battery_vol_sum"]
+                    stored["network_sum"] += inc["network_sum"]
+                    stored["WH_min"] = min(stored["WH_min"], inc["WH_min"])
+                    stored["WH_max"] = max(stored["WH_max"], inc["WH_max"])
+                    if inc["last"]["timestamp"] >= stored["last"]["timestamp"]:
+                        stored["last"] = inc["last"]
+        return [None] * len(readings)
+
+    def is_available(self):
+        return True
+
+    def list_latest(self):
+        with self._lock:
+            return [{field: state[field] for field in LATEST_OUTPUT_FIELDS if field in state}
+                    for _, state in sorted(self._latest.items())]
+
+    def iter_history(self, meter_id, start_date, after=None, limit=None, batch_size=None):
+        with self._lock:
+            keys = self._reading_keys.get(meter_id, [])
+            start = bisect.bisect_left(keys, (start_date,))
+            if after is not None:
+                start = max(start, bisect.bisect_right(keys, after))
+            end = len(keys) if limit is None else min(len(keys), start + limit)
+            docs = self._readings.get(meter_id, [])[start:end]
+        return ({field: doc[field] for field in HISTORY_FIELDS if field in doc} for doc in docs)
+
+    def iter_fleet_readings(self, start_date, until, after=None, batch_size=None):
+        with self._lock:
+            ranges = []
+            for mid, keys in self._reading_keys.items():
+                start = bisect.bisect_left(keys, (start_date,))
+                if after is not None:
+                    start = max(start, bisect.bisect_right(keys, after))
+                ranges.append(self._readings[mid][start:bisect.bisect_left(keys, (until,))])
+        docs = heapq.merge(*ranges, key=lambda doc: (doc["timestamp"], doc["_id"]))
+        return ({field: doc[field] for field in FLEET_READING_FIELDS} for doc in docs)
+
+    def iter_rollups(self, meter_id, start_date, resolution, after=None, limit=None, batch_size=None):
+        first_bucket = bucket_start(start_date, resolution)
+        with self._lock:
+            buckets = self._rollups[resolution].get(meter_id, {})
+            rows = [rollup_row(buckets[bucket]) for bucket in sorted(buckets)
+                    if bucket >= first_bucket and (after is None or bucket > after[0])]
+        return iter(rows if limit is None else rows[:limit])
+
+    def find_active_alerts(self):
+        with self._lock:
+            return [{field: state[field] for field in ACTIVE_ALERT_FIELDS if field in state}
+                    for _, state in sorted(self._latest.items()) if state.get("alert_active")]
+
+    def find_alert_transitions(self, meter_id, limit=100):
+        with self._lock:
+            transitions = self._transitions.get(meter_id, [])[-limit:]
+        return [dict(transition) for transition in reversed(transitions)]
+
+    def create_metadata(self, doc):
+        with self._lock:
+            if doc["MID"] in self._metadata:
+                return None
+            doc.setdefault("_id", ObjectId())
+            self._metadata[doc["MID"]] = dict(doc)
+            return dict(doc)
+
+    def find_metadata(self, mid):
+        with self._lock:
+            doc = self._metadata.get(mid)
+            return dict(doc) if doc is not None else None
+
+    def list_metadata(self, fields=None, after=None, limit=None):
+        with self._lock:
+            mids = sorted(mid for mid in self._metadata if after is None or mid > after)[:limit]
+            if fields is None:
+                return [dict(self._metadata[mid]) for mid in mids]
+            return [{key: value for key, value in self._metadata[mid].items() if key == "MID" or key in fields}
+                    for mid in mids]
+
+    def update_metadata(self, mid, fields):
+        with self._lock:
+            doc = self._metadata.get(mid)
+            if doc is None:
+                return None
+            doc.update(fields)
+            return dict(doc)
+
+    def delete_metadata(self, mid):
+        with self._lock:
+            return self._metadata.pop(mid, None) is not None
+
+    def write_metadata(self, docs, upsert=False):
+        results = []
+        with self._lock:
+            for doc in docs:
+                stored = self._metadata.get(doc["MID"])
+                if stored is None:
+                    self._metadata[doc["MID"]] = {"_id": ObjectId(), **doc}
+                    results.append(("created", None))
+                elif upsert:
+                    stored.update(doc)
+                    results.append(("updated", None))
+                else:
+                    results.append(("conflict", f"Meter metadata with MID {doc['MID']} already exists."))
+        return results
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Returns the process's MeterStore, selected by METER_STORE."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if METER_STORE == "memory":
+                    logger.warning("Using the in-memory MeterStore: data is per process and not persisted.")
+                    _store = MemoryMeterStore()
+                elif METER_STORE == "mongo":
+                    from db_mongo_config import get_db, is_connected # Only the Mongo store needs MONGO_URI
+                    _store = MongoMeterStore(get_db, is_connected)
+                else:
+                    raise ValueError(f"Unknown METER_STORE '{METER_STORE}'. Use mongo or memory.")
+    return _store
@@ -0,0 +1,290 @@
+# metrics.py
+import collections
+import datetime
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from flask import Response, g, request
+from pymongo import monitoring
+
+try:
+    import prometheus_client # Optional: enables /metrics
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# --- Metrics Settings ---
+# Prometheus metrics at /metrics. Under gunicorn every worker writes its values to files in
+# PROMETHEUS_MULTIPROC_DIR (set by gunicorn.conf.py) and a scrape of any worker returns
+# the sum over all of them; without it, /metrics reports the current process only.
+METRICS_ENABLED = prometheus_client is not None and os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# Slow-request profiler (off unless PROFILE_SLOW_REQUEST_MS is set): in-flight requests
+# are sampled every PROFILE_SAMPLE_INTERVAL_MS, and the stacks of requests that take at
+# least PROFILE_SLOW_REQUEST_MS are written to PROFILE_DIR in folded format, one file per
+# request (input for flamegraph.pl, speedscope or inferno).
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get("PROFILE_SLOW_REQUEST_MS", "0"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+_MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+if METRICS_ENABLED:
+    if PROMETHEUS_MULTIPROC_DIR:
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    REQUEST_LATENCY = Histogram("http_request_duration_seconds",
+                                "Request latency, until the last byte of streamed bodies",
+                                ["method", "route", "status"])
+    REQUEST_SIZE = Histogram("http_request_size_bytes", "Request body size", ["method", "route"],
+                             buckets=_SIZE_BUCKETS)
+    RESPONSE_SIZE = Histogram("http_response_size_bytes", "Response body size", ["method", "route"],
+                              buckets=_SIZE_BUCKETS)
+    PARSE_FAILURES = Counter("sms_parse_failures_total", "Rejected SMS payloads by reason "
+                             "(see sms_parser.PARSE_FAILURE_REASONS)", ["reason"])
+    MONGO_COMMAND_LATENCY = Histogram("mongodb_command_duration_seconds", "MongoDB command round trips",
+                                      ["command", "collection"], buckets=_MONGO_BUCKETS)
+    MONGO_COMMAND_FAILURES = Counter("mongodb_command_failures_total", "Failed MongoDB commands",
+                                     ["command", "collection"])
+    # livesum: summed over running workers; a dead worker's connections are dropped (child_exit)
+    MONGO_POOL_CONNECTIONS = Gauge("mongodb_pool_connections", "Open pooled connections",
+                                   ["address"], multiprocess_mode="livesum")
+    MONGO_POOL_CHECKED_OUT = Gauge("mongodb_pool_checked_out_connections", "Connections in use by operations",
+                                   ["address"], multiprocess_mode="livesum")
+    MONGO_POOL_CHECKOUT_LATENCY = Histogram("mongodb_pool_checkout_duration_seconds",
+                                            "Time waiting for a pooled connection", ["address"],
+                                            buckets=_MONGO_BUCKETS)
+    MONGO_POOL_CHECKOUT_FAILURES = Counter("mongodb_pool_checkout_failures_total",
+                                           "Connection checkouts that failed", ["address", "reason"])
+
+
+def record_parse_failures(reasons):
+    """Counts rejected payloads; `reasons` maps failure_reason values to counts."""
+    if METRICS_ENABLED:
+        for reason, count in reasons.items():
+            PARSE_FAILURES.labels(reason).inc(count)
+
+
+# --- MongoDB Instrumentation ---
+
+def _address(event):
+    host, port = event.address
+    return f"{host}:{port}"
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command by command name and collection."""
+
+    def __init__(self):
+        self._pending = {} # (connection id, request id) -> (command, collection)
+
+    def started(self, event):
+        # The collection is the value of the command's first key ({"find": "meter_data", ...}),
+        # except for getMore
+        key = "collection" if event.command_name == "getMore" else event.command_name
+        target = event.command.get(key)
+        collection = target if isinstance(target, str) else ""
+        self._pending[(event.connection_id, event.request_id)] = (event.command_name, collection)
+
+    def _finish(self, event):
+        return self._pending.pop((event.connection_id, event.request_id), (event.command_name, ""))
+
+    def succeeded(self, event):
+        command, collection = self._finish(event)
+        MONGO_COMMAND_LATENCY.labels(command, collection).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        command, collection = self._finish(event)
+        MONGO_COMMAND_LATENCY.labels(command, collection).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(command, collection).inc()
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Tracks open and checked-out pooled connections per server."""
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass # Its connections are closed (and reported) as they are returned
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.labels(_address(event)).inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.labels(_address(event)).dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_CHECKOUT_FAILURES.labels(_address(event), str(event.reason)).inc()
+
+    def connection_checked_out(self, event):
+        address = _address(event)
+        MONGO_POOL_CHECKED_OUT.labels(address).inc()
+        duration = getattr(event, "duration", None) # pymongo 4.7+
+        if duration is not None:
+            MONGO_POOL_CHECKOUT_LATENCY.labels(address).observe(duration)
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CHECKED_OUT.labels(_address(event)).dec()
+
+
+def mongo_event_listeners():
+    """Listeners to pass to MongoClient(event_listeners=...); empty when metrics are off."""
+    if not METRICS_ENABLED:
+        return []
+    return [CommandMetrics(), PoolMetrics()]
+
+
+# --- Slow-Request Profiler ---
+
+def _folded_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of in-flight requests; keeps those of slow requests."""
+
+    def __init__(self, threshold_ms=PROFILE_SLOW_REQUEST_MS, interval_ms=PROFILE_SAMPLE_INTERVAL_MS,
+                 directory=PROFILE_DIR):
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000
+        self.directory = directory
+        self._active = {} # thread ident -> Counter of folded stacks
+        self._sampler = None
+        self._sampler_pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Per process, after fork (threads do not survive it)
+        if self._sampler is not None and self._sampler_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sampler is not None and self._sampler_pid == os.getpid():
+                return
+            self._sampler_pid = os.getpid()
+            self._sampler = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+            self._sampler.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            for ident, samples in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples[_folded_stack(frame)] += 1
+
+    def start_request(self):
+        self._ensure_started()
+        self._active[threading.get_ident()] = collections.Counter()
+
+    def finish_request(self, route, seconds):
+        samples = self._active.pop(threading.get_ident(), None)
+        if not samples or seconds * 1000 < self.threshold_ms:
+            return
+        name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        path = os.path.join(self.directory, f"{datetime.datetime.utcnow():%Y%m%dT%H%M%S}-{name}-"
+                                            f"{os.getpid()}-{round(seconds * 1000)}ms.folded")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            logger.warning(f"Slow request {route} ({seconds * 1000:.0f} ms): stack profile written to {path}")
+        except OSError as e:
+            logger.error(f"Could not write stack profile {path}: {e}")
+
+
+# --- Flask Integration ---
+
+def _observe(method, route, status, started, request_size, response_size, profiler):
+    seconds = time.perf_counter() - started
+    if METRICS_ENABLED:
+        REQUEST_LATENCY.labels(method, route, status).observe(seconds)
+        if request_size is not None:
+            REQUEST_SIZE.labels(method, route).observe(request_size)
+        RESPONSE_SIZE.labels(method, route).observe(response_size)
+    if profiler is not None:
+        profiler.finish_request(route, seconds)
+
+
+def _counted_body(body, on_close):
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        on_close(size)
+
+
+def metrics_response():
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Adds request metrics, the /metrics endpoint and the slow-request profiler to `app`."""
+    profiler = SlowRequestProfiler() if PROFILE_SLOW_REQUEST_MS > 0 else None
+    if not METRICS_ENABLED and profiler is None:
+        if prometheus_client is None:
+            logger.info("prometheus_client is not installed; /metrics is disabled.")
+        return
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        if profiler is not None:
+            profiler.start_request()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop("request_started", None)
+        if started is None:
+            return response
+        # The URL rule rather than the path, so meter IDs do not become label values
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        method, status, request_size = request.method, str(response.status_code), request.content_length
+        observe = lambda size: _observe(method, route, status, started, request_size, size, profiler)
+        if response.is_streamed:
+            # Observed once the WSGI server has sent the last chunk (or the client went away)
+            response.response = _counted_body(response.response, observe)
+        else:
+            observe(response.calculate_content_length() or 0)
+        return response
+
+    if METRICS_ENABLED:
+        app.add_url_rule("/metrics", "metrics", metrics_response)
+        mode = f"multiprocess ({PROMETHEUS_MULTIPROC_DIR})" if PROMETHEUS_MULTIPROC_DIR else "single process"
+        logger.info(f"Prometheus metrics enabled at /metrics, {mode}.")
+    if profiler is not None:
+        logger.info(f"Profiling requests slower than {PROFILE_SLOW_REQUEST_MS} ms into {PROFILE_DIR}.")
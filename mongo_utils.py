@@ -0,0 +1,114 @@
+# mongo_utils.py
+import logging
+import os
+import threading
+import time
+from bson.errors import InvalidDocument
+from pymongo import errors
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# Driver-level helpers shared by the ingest pipeline, the metadata store and the caches.
+# Imports nothing from the app, so any module (db_mongo_config included) may use it.
+
+# writeErrors code of a unique index violation
+DUPLICATE_KEY_ERROR = 11000
+
+# --- Bulk Writes ---
+
+# Prefix of the per-item error for readings that were not written because MongoDB was
+# unreachable. Only these are worth writing again later (see ingest_buffer.py).
+DATABASE_UNAVAILABLE = "Database unavailable"
+
+
+def is_retryable(error):
+    """True for a per-item error from a connection failure rather than a rejected document."""
+    return bool(error) and error.startswith(DATABASE_UNAVAILABLE)
+
+
+def bulk_write_chunks(collection, items, make_operation, chunk_size):
+    """Writes make_operation(item) for every item, in unordered bulk_write calls of chunk_size.
+
+    Returns (write_errors, upserted): write_errors is aligned with `items`, None for every
+    operation that succeeded, otherwise a dict with "errmsg" and, for errors reported by
+    the server, its "code"; upserted holds the indexes of the items an upsert inserted.
+    """
+    write_errors = [None] * len(items)
+    upserted = set()
+    for start in range(0, len(items), chunk_size):
+        if not _bulk_write_range(collection, items, make_operation, start, min(start + chunk_size, len(items)),
+                                 write_errors, upserted):
+            break
+    return write_errors, upserted
+
+
+def _bulk_write_range(collection, items, make_operation, start, end, write_errors, upserted):
+    """One bulk_write of items[start:end]. Returns False if the server was unreachable."""
+    try:
+        result = collection.bulk_write([make_operation(item) for item in items[start:end]], ordered=False)
+        upserted.update(start + index for index in result.upserted_ids)
+        return True
+    except errors.BulkWriteError as e:
+        # Unordered: everything except the reported indexes was written
+        for write_error in e.details.get("writeErrors", []):
+            write_errors[start + write_error["index"]] = write_error
+        upserted.update(start + entry["index"] for entry in e.details.get("upserted", []))
+        return True
+    except (OverflowError, InvalidDocument) as e:
+        # Raised by the client while encoding, before the operations are sent
+        if end - start == 1:
+            logger.error(f"Unencodable document for {collection.name} at offset {start}: {e}")
+            write_errors[start] = {"errmsg": f"Invalid document: {e}"}
+            return True
+    except errors.ConnectionFailure as e:
+        # The remaining chunks would only wait out the same server selection timeout
+        logger.error(f"MongoDB connection failure writing to {collection.name} at offset {start}: {e}")
+        for i in range(start, len(items)):
+            write_errors[i] = {"errmsg": f"{DATABASE_UNAVAILABLE}: {e}"}
+        return False
+    except errors.PyMongoError as e:
+        logger.error(f"MongoDB error writing to {collection.name} at offset {start}: {e}")
+        for i in range(start, end):
+            write_errors[i] = {"errmsg": str(e)}
+        return True
+    # Write the halves until the documents that do not encode are isolated
+    middle = (start + end) // 2
+    return (_bulk_write_range(collection, items, make_operation, start, middle, write_errors, upserted)
+            and _bulk_write_range(collection, items, make_operation, middle, end, write_errors, upserted))
+
+
+# --- Change Streams ---
+
+class ChangeStreamWatcher:
+    """Calls `on_change()` on every change to the watched collections, from any writer.
+
+    Started lazily per process (threads do not survive fork). On errors it reconnects,
+    calling `on_change()` first since changes may have been missed while disconnected.
+    """
+
+    def __init__(self, name, on_change):
+        self.name = name
+        self.on_change = on_change
+        self._thread = None
+        self._pid = None
+
+    def start(self, get_db, collections_to_watch):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, args=(get_db, list(collections_to_watch)),
+                                        name=self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self, get_db, collections_to_watch):
+        pipeline = [{"$match": {"ns.coll": {"$in": collections_to_watch}}}, {"$project": {"_id": 1}}]
+        while True:
+            try:
+                with get_db().watch(pipeline) as stream:
+                    logger.info(f"{self.name} watching changes on {collections_to_watch}.")
+                    for _ in stream:
+                        self.on_change()
+            except errors.PyMongoError as e:
+                logger.warning(f"{self.name}: change stream interrupted: {e}")
+                self.on_change()
+                time.sleep(5)
@@ -0,0 +1,184 @@
+# response_cache.py
+import collections
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from flask import make_response, request
+
+from mongo_utils import ChangeStreamWatcher
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# --- Cache Settings ---
+# Serialized responses are cached per worker for at most RESPONSE_CACHE_TTL_S, and
+# dropped as soon as this worker ingests a reading (generation counter). Readings ingested
+# by other workers are picked up when the TTL expires, or immediately with
+# RESPONSE_CACHE_CHANGE_STREAM=true (needs a replica set, e.g. Atlas).
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL_S = float(os.environ.get("RESPONSE_CACHE_TTL_S", "5"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+# Total body bytes held per worker, and the largest body worth keeping (larger responses
+# still get validators but are not stored)
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+RESPONSE_CACHE_CHANGE_STREAM = os.environ.get("RESPONSE_CACHE_CHANGE_STREAM", "false").lower() == "true"
+
+# Concurrent misses are serialized per key through a fixed set of locks (keys hash onto them)
+_KEY_LOCK_STRIPES = 64
+
+
+class CacheEntry:
+    def __init__(self, body, mimetype, generation, previous=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.generation = generation
+        self.created = time.monotonic()
+        # Strong validator: identical bytes produce an identical ETag on every worker
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        if previous is not None:
+            # `previous` is the entry this one replaces. Last-Modified has one-second
+            # resolution, so a changed body must still move it forward, or clients
+            # revalidating with If-Modified-Since would keep the old body.
+            if previous.etag == self.etag:
+                self.last_modified = previous.last_modified
+            elif self.last_modified <= previous.last_modified:
+                self.last_modified = previous.last_modified + datetime.timedelta(seconds=1)
+
+
+class ResponseCache:
+    """Per-worker cache of serialized GET responses with ETag/Last-Modified revalidation."""
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL_S, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY_BYTES,
+                 enabled=RESPONSE_CACHE_ENABLED):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.enabled = enabled
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(_KEY_LOCK_STRIPES)]
+        self._counters = collections.Counter()
+        self._watcher = ChangeStreamWatcher("response-cache-watcher", self.bump_generation)
+
+    # --- Invalidation ---
+
+    def bump_generation(self):
+        """Marks every cached response stale (called after this worker ingests readings)."""
+        with self._lock:
+            self.generation += 1
+            self._counters["invalidations"] += 1
+
+    def start_change_stream(self, get_db, collections_to_watch):
+        """Bumps the generation on every change to the given collections (see ChangeStreamWatcher)."""
+        self._watcher.start(get_db, collections_to_watch)
+
+    # --- Lookup ---
+
+    def _key_lock(self, key):
+        return self._key_locks[hash(key) % len(self._key_locks)]
+
+    def _get(self, key):
+        """Returns (entry, fresh); stale entries stay until replaced or evicted (see CacheEntry)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            if entry.generation != self.generation or time.monotonic() - entry.created > self.ttl:
+                return entry, False
+            self._entries.move_to_end(key)
+            return entry, True
+
+    def _put(self, key, entry):
+        with self._lock:
+            replaced = self._entries.pop(key, None)
+            if replaced is not None:
+                self._bytes -= len(replaced.body)
+            self._entries[key] = entry
+            self._bytes += len(entry.body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+            size_bytes = self._bytes
+        return {
+            "enabled": self.enabled,
+            "entries": size,
+            "bytes": size_bytes,
+            "generation": self.generation,
+            "hits": self._counters["hits"],
+            "misses": self._counters["misses"],
+            "not_modified": self._counters["not_modified"],
+            "invalidations": self._counters["invalidations"],
+            "bypassed": self._counters["bypassed"],
+            "too_large": self._counters["too_large"],
+        }
+
+    # --- View Decorator ---
+
+    def cached(self, when=None):
+        """Caches a GET view's 200 responses and answers conditional requests with 304.
+
+        `when` (optional, called inside the request) returns False for requests that must
+        not be cached, e.g. unbounded streams. Concurrent misses on one key are computed once.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or (when is not None and not when()):
+                    self._counters["bypassed"] += 1
+                    return view(*args, **kwargs)
+
+                key = (request.path, tuple(sorted(request.args.items(multi=True))),
+                       request.headers.get("Accept", ""))
+                entry, fresh = self._get(key)
+                if not fresh:
+                    with self._key_lock(key):
+                        entry, fresh = self._get(key) # Another thread may have filled it meanwhile
+                        if not fresh:
+                            generation = self.generation # Read before the view runs: newer ingests invalidate
+                            response = make_response(view(*args, **kwargs))
+                            if response.status_code != 200:
+                                return response
+                            entry = CacheEntry(response.get_data(), response.mimetype, generation, previous=entry)
+                            if len(entry.body) <= self.max_entry_bytes:
+                                self._put(key, entry)
+                            else:
+                                self._counters["too_large"] += 1
+                            self._counters["misses"] += 1
+                        else:
+                            self._counters["hits"] += 1
+                else:
+                    self._counters["hits"] += 1
+                return self._respond(entry)
+            return wrapper
+        return decorator
+
+    def _respond(self, entry):
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(entry.etag)
+        elif request.if_modified_since:
+            not_modified = entry.last_modified <= request.if_modified_since
+        else:
+            not_modified = False
+        if not_modified:
+            self._counters["not_modified"] += 1
+            response = make_response("", 304)
+        else:
+            response = make_response(entry.body)
+            response.mimetype = entry.mimetype
+        response.set_etag(entry.etag)
+        response.last_modified = entry.last_modified
+        response.headers["Cache-Control"] = "no-cache" # Clients may store it but must revalidate
+        return response
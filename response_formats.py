@@ -0,0 +1,57 @@
+# response_formats.py
+import datetime
+import json
+from flask import Response, request
+
+try:
+    import msgpack # Optional: enables Accept: application/msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_SECOND = datetime.timedelta(seconds=1)
+
+
+def epoch_seconds(timestamp):
+    """Naive UTC datetime -> integer seconds since the Unix epoch."""
+    return (timestamp - _EPOCH) // _SECOND
+
+
+def to_columnar(docs, fields):
+    """Turns documents into {field: [values...]} with timestamps as epoch seconds.
+
+    Keys are written once instead of once per row, and no timestamp string formatting is
+    done; missing fields become null so every column has the same length.
+    """
+    columns = {field: [] for field in fields}
+    appenders = [(field, columns[field].append) for field in fields]
+    for doc in docs:
+        for field, append in appenders:
+            value = doc.get(field)
+            if isinstance(value, datetime.datetime):
+                value = epoch_seconds(value)
+            append(value)
+    return columns
+
+
+def negotiated_mimetype():
+    """Chooses JSON or MessagePack from the Accept header (JSON unless msgpack is preferred).
+
+    Returns None when MessagePack was asked for explicitly but is not installed.
+    """
+    best = request.accept_mimetypes.best_match(("application/json",) + MSGPACK_MIMETYPES,
+                                               default="application/json")
+    if best in MSGPACK_MIMETYPES:
+        return best if msgpack is not None else None
+    return "application/json"
+
+
+def encode_payload(payload, mimetype):
+    """Serializes a JSON-compatible payload as compact JSON or MessagePack."""
+    if mimetype in MSGPACK_MIMETYPES:
+        body = msgpack.packb(payload, use_bin_type=True)
+    else:
+        body = json.dumps(payload, separators=(",", ":"))
+    return Response(body, mimetype=mimetype)
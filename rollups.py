@@ -0,0 +1,129 @@
+# rollups.py
+import logging
+from pymongo import ASCENDING, UpdateOne
+
+logger = logging.getLogger(__name__) # Assumes logger is configured in app.py
+
+# Pre-aggregated history, one document per meter per bucket:
+#   {MID, bucket, count, WH_min, WH_max, last: {timestamp, WH}, battery_vol_sum, network_sum}
+# Ingest keeps them current with $inc/$min/$max upserts; averages are derived on read.
+ROLLUP_COLLECTIONS = {
+    "hour": "meter_rollup_hour",
+    "day": "meter_rollup_day",
+}
+
+
+def bucket_start(timestamp, resolution):
+    """Truncates a datetime to the start of its hour or day bucket."""
+    if resolution == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def bucket_increments(readings, resolution):
+    """Folds readings into one pending increment per (MID, bucket)."""
+    increments = {}
+    for doc in readings:
+        key = (doc["MID"], bucket_start(doc["timestamp"], resolution))
+        inc = increments.get(key)
+        if inc is None:
+            increments[key] = {"count": 1, "WH_min": doc["WH"], "WH_max": doc["WH"],
+                               "last": {"timestamp": doc["timestamp"], "WH": doc["WH"]},
+                               "battery_vol_sum": doc["battery_vol"], "network_sum": doc["network"]}
+            continue
+        inc["count"] += 1
+        inc["WH_min"] = min(inc["WH_min"], doc["WH"])
+        inc["WH_max"] = max(inc["WH_max"], doc["WH"])
+        if doc["timestamp"] >= inc["last"]["timestamp"]:
+            inc["last"] = {"timestamp": doc["timestamp"], "WH": doc["WH"]}
+        inc["battery_vol_sum"] += doc["battery_vol"]
+        inc["network_sum"] += doc["network"]
+    return increments
+
+
+def apply_rollups(db, readings):
+    """Adds readings to the hourly and daily rollups with one unordered bulk_write each.
+
+    `last` is an embedded {timestamp, WH} document updated with $max: BSON compares
+    documents field by field in order, so the entry with the newest timestamp wins and
+    late-arriving readings cannot replace it.
+    """
+    for resolution, collection_name in ROLLUP_COLLECTIONS.items():
+        operations = []
+        for (mid, bucket), inc in bucket_increments(readings, resolution).items():
+            operations.append(UpdateOne(
+                {"MID": mid, "bucket": bucket},
+                {"$inc": {"count": inc["count"], "battery_vol_sum": inc["battery_vol_sum"],
+                          "network_sum": inc["network_sum"]},
+                 "$min": {"WH_min": inc["WH_min"]},
+                 "$max": {"WH_max": inc["WH_max"], "last": inc["last"]}},
+                upsert=True))
+        if operations:
+            db[collection_name].bulk_write(operations, ordered=False)
+
+
+def find_rollups(db, meter_id, start_date, resolution, after=None, limit=None, batch_size=None):
+    """Yields the meter's buckets from start_date on, oldest first, with averages computed.
+
+    `after` is a (bucket, _id) keyset position as decoded by history.decode_cursor;
+    `limit` caps the number of documents read from the server.
+    """
+    query = {"MID": meter_id, "bucket": {"$gte": bucket_start(start_date, resolution)}}
+    if after is not None:
+        # (MID, bucket) is unique, so the bucket alone orders rows
+        query["bucket"]["$gt"] = after[0]
+    cursor = db[ROLLUP_COLLECTIONS[resolution]].find(query, {"MID": 0}).sort("bucket", ASCENDING)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    for doc in cursor:
+        yield rollup_row(doc)
+
+
+def rollup_row(doc):
+    """Converts a stored bucket into its API row, deriving the averages."""
+    count = doc.get("count") or 1
+    return {
+        "_id": doc["_id"],
+        "timestamp": doc["bucket"],
+        "readings": doc.get("count", 0),
+        "WH_min": doc.get("WH_min"),
+        "WH_max": doc.get("WH_max"),
+        "WH_last": doc.get("last", {}).get("WH"),
+        "battery_vol_avg": round(doc.get("battery_vol_sum", 0) / count, 1),
+        "network_avg": round(doc.get("network_sum", 0) / count, 1),
+    }
+
+
+def rebuild_rollups(db):
+    """Regenerates both rollup collections from meter_data (backfill and repair).
+
+    Buckets are replaced with values recomputed from the raw readings, so increments
+    ingested while the rebuild runs can be lost; run it with ingest paused. Readings
+    moved to the archive (archive.py) are not seen: buckets entirely before the
+    retention cutoff are left as they are, but one that straddles it is recomputed
+    from its live readings only.
+    Requires MongoDB 5.0+ for $dateTrunc.
+    """
+    counts = {}
+    for resolution, collection_name in ROLLUP_COLLECTIONS.items():
+        pipeline = [
+            {"$group": {
+                "_id": {"MID": "$MID", "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": resolution}}},
+                "count": {"$sum": 1},
+                "WH_min": {"$min": "$WH"},
+                "WH_max": {"$max": "$WH"},
+                "last": {"$max": {"timestamp": "$timestamp", "WH": "$WH"}},
+                "battery_vol_sum": {"$sum": "$battery_vol"},
+                "network_sum": {"$sum": "$network"},
+            }},
+            {"$set": {"MID": "$_id.MID", "bucket": "$_id.bucket"}},
+            {"$unset": "_id"},
+            {"$merge": {"into": collection_name, "on": ["MID", "bucket"],
+                        "whenMatched": "replace", "whenNotMatched": "insert"}},
+        ]
+        db["meter_data"].aggregate(pipeline, allowDiskUse=True)
+        counts[resolution] = db[collection_name].count_documents({})
+        logger.info(f"Rebuilt {collection_name}: {counts[resolution]} buckets.")
+    return counts
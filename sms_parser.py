@@ -0,0 +1,188 @@
+# sms_parser.py
+import itertools
+import re
+import numpy as np
+
+from alert_rules import status_code_for, status_codes_for_columns
+
+# Gateway messages look like "#S,<MID>,@,<battery mV>,<network>,<WH>". The pattern is
+# the original parser's and defines what is accepted; anything the split fast path
+# below does not take is decided by it.
+SMS_PATTERN = re.compile(r"^\s*([^,]+)\s*,\s*(\w+)\s*,\s*([^,]+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*$")
+
+# Why a message was rejected (see failure_reason)
+PARSE_FAILURE_REASONS = ("not_text", "empty", "field_count", "empty_field", "invalid_mid", "non_numeric",
+                         "out_of_range", "malformed")
+
+# Largest number accepted: readings are stored as BSON integers, which are at most 64-bit
+INT64_MAX = 2 ** 63 - 1
+
+_WORD = re.compile(r"\w+")
+_DIGITS = re.compile(r"\d+")
+
+# Fields longer than these are left to the scalar path (int64 holds 18 digits safely)
+_MAX_FAST_DIGITS = 18
+_MAX_FAST_MID = 32
+
+
+def parse_sms(sms_string, rules=None):
+    """Parses one message into {"MID", "battery_vol", "network", "WH", "status_code"}.
+
+    Numbers are ints. status_code is FORMAT_WARN for an unexpected start marker or
+    separator, otherwise the first matching alert rule (alert_rules.py) or "OK".
+    Returns None if the message does not match SMS_PATTERN or a number exceeds INT64_MAX.
+    """
+    if not isinstance(sms_string, str):
+        return None
+    parts = sms_string.split(",")
+    # Fast path: well-formed messages without whitespace, for which the pattern's groups
+    # are exactly the comma-separated fields (isalnum is \w without "_", isdecimal is \d).
+    if (len(parts) == 6 and parts[0] == "#S" and parts[2] == "@" and parts[1].isalnum()
+            and parts[3].isdecimal() and parts[4].isdecimal() and parts[5].isdecimal()):
+        start_char, mid, separator_char, battery, network, wh = parts
+    else:
+        match = SMS_PATTERN.match(sms_string)
+        if match is None:
+            return None
+        start_char, mid, separator_char, battery, network, wh = match.groups()
+    try:
+        record = {"MID": mid, "battery_vol": int(battery), "network": int(network), "WH": int(wh)}
+    except ValueError: # More digits than int() accepts (sys.get_int_max_str_digits)
+        return None
+    if max(record["battery_vol"], record["network"], record["WH"]) > INT64_MAX:
+        return None
+    if start_char != "#S" or separator_char != "@":
+        record["status_code"] = "FORMAT_WARN"
+    else:
+        record["status_code"] = status_code_for(record, rules)
+    return record
+
+
+def failure_reason(sms_string):
+    """Classifies a message parse_sms rejected (one of PARSE_FAILURE_REASONS)."""
+    if not isinstance(sms_string, str):
+        return "not_text"
+    if not sms_string.strip():
+        return "empty"
+    fields = [field.strip() for field in sms_string.split(",")]
+    if len(fields) != 6:
+        return "field_count"
+    if not all(fields):
+        return "empty_field"
+    if not _WORD.fullmatch(fields[1]):
+        return "invalid_mid"
+    if not all(_DIGITS.fullmatch(field) for field in fields[3:]):
+        return "non_numeric"
+    # Length first: int() refuses numbers with thousands of digits
+    if any(len(field.lstrip("0")) > len(str(INT64_MAX)) or int(field) > INT64_MAX for field in fields[3:]):
+        return "out_of_range"
+    return "malformed"
+
+
+def _byte_table(characters):
+    table = np.zeros(256, dtype=bool)
+    table[list(characters.encode())] = True
+    return table
+
+
+# ASCII bytes the fast path accepts in a MID and in a number
+_MID_BYTES = _byte_table("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+_DIGIT_BYTES = _byte_table("0123456789")
+
+
+def _field_bytes(data, starts, ends, max_width):
+    """Gathers tokens into a (tokens, width) byte matrix, right-aligned.
+
+    Returns (matrix, padding, fits): padding marks the cells left of each token, and fits
+    is False for tokens that are empty or longer than max_width (and so truncated).
+    """
+    lengths = ends - starts
+    fits = (lengths > 0) & (lengths <= max_width)
+    width = int(min(max(lengths.max(), 1), max_width))
+    columns = np.arange(width)
+    padding = columns < (width - np.minimum(lengths, width))[:, None]
+    matrix = data[np.maximum(ends[:, None] - width + columns, 0)]
+    return matrix, padding, fits
+
+
+def _scan_fields(joined, size):
+    """Vectorized fast path over `size` comma-joined ASCII messages of six fields each.
+
+    Field k of message i is token 6 * i + k of the joined text. Returns (fast, mid_starts,
+    mid_ends, numbers): fast marks messages the split fast path of parse_sms would take
+    (with numbers of at most _MAX_FAST_DIGITS digits), and numbers is an int64 (size, 3)
+    array of battery_vol, network and WH, meaningful where fast.
+    """
+    data = np.frombuffer(joined.encode("ascii"), dtype=np.uint8)
+    commas = np.flatnonzero(data == ord(","))
+    starts = np.concatenate(([0], commas + 1)).reshape(size, 6)
+    ends = np.append(commas, len(data)).reshape(size, 6)
+    lengths = ends - starts
+
+    # "#S" and "@" markers, compared on their (clipped) first two bytes
+    first = data[np.minimum(starts[:, [0, 0, 2]] + [0, 1, 0], len(data) - 1)]
+    fast = ((lengths[:, 0] == 2) & (first[:, 0] == ord("#")) & (first[:, 1] == ord("S"))
+            & (lengths[:, 2] == 1) & (first[:, 2] == ord("@")))
+
+    mid, padding, fits = _field_bytes(data, starts[:, 1], ends[:, 1], _MAX_FAST_MID)
+    fast &= fits & (padding | _MID_BYTES[mid]).all(axis=1)
+
+    numbers = np.zeros((size, 3), dtype=np.int64)
+    for index in range(3):
+        digits, padding, fits = _field_bytes(data, starts[:, 3 + index], ends[:, 3 + index], _MAX_FAST_DIGITS)
+        fast &= fits & (padding | _DIGIT_BYTES[digits]).all(axis=1)
+        # Digits times their place values (padding counts as 0)
+        places = 10 ** np.arange(digits.shape[1] - 1, -1, -1, dtype=np.int64)
+        numbers[:, index] = np.where(padding, 0, digits.astype(np.int64) - ord("0")) @ places
+    return fast, starts[:, 1], ends[:, 1], numbers
+
+
+def parse_batch(messages, rules=None):
+    """Parses a list of messages into columns, with status codes applied per column.
+
+    Returns a dict of equal-length NumPy arrays: "valid" (bool), "MID" and "status_code"
+    (object, None where invalid), "battery_vol", "network" and "WH" (int64, 0 where invalid)
+    and "reason" (object, failure_reason where invalid).
+    Row i has the same values as parse_sms(messages[i]).
+    """
+    count = len(messages)
+    texts = messages if set(map(type, messages)) <= {str} else [m if isinstance(m, str) else "" for m in messages]
+    # Fast path candidates: ASCII messages with exactly six fields
+    is_candidate = np.fromiter(map(str.count, texts, itertools.repeat(",")), dtype=np.intp, count=count) == 5
+    joined = ",".join(itertools.compress(texts, is_candidate.tolist()))
+    if not joined.isascii():
+        is_candidate &= np.fromiter(map(str.isascii, texts), dtype=bool, count=count)
+        joined = ",".join(itertools.compress(texts, is_candidate.tolist()))
+    candidate_rows = np.flatnonzero(is_candidate)
+
+    columns = {
+        "valid": np.zeros(count, dtype=bool),
+        "MID": np.full(count, None, dtype=object),
+        "battery_vol": np.zeros(count, dtype=np.int64),
+        "network": np.zeros(count, dtype=np.int64),
+        "WH": np.zeros(count, dtype=np.int64),
+        "status_code": np.full(count, None, dtype=object),
+        "reason": np.full(count, None, dtype=object),
+    }
+    if len(candidate_rows):
+        fast, mid_starts, mid_ends, numbers = _scan_fields(joined, len(candidate_rows))
+        fast_rows = candidate_rows[fast]
+        columns["valid"][fast_rows] = True
+        # ASCII, so byte offsets are character offsets into the joined text
+        columns["MID"][fast_rows] = list(map(joined.__getitem__, map(slice, mid_starts[fast].tolist(),
+                                                                     mid_ends[fast].tolist())))
+        for index, field in enumerate(("battery_vol", "network", "WH")):
+            columns[field][fast_rows] = numbers[fast, index]
+        columns["status_code"][fast_rows] = status_codes_for_columns(
+            {field: columns[field][fast_rows] for field in ("battery_vol", "network", "WH")}, rules)
+
+    # Everything else (whitespace, other markers, malformed input) goes through parse_sms
+    for row in np.flatnonzero(~columns["valid"]).tolist():
+        record = parse_sms(messages[row], rules)
+        if record is None:
+            columns["reason"][row] = failure_reason(messages[row])
+            continue
+        columns["valid"][row] = True
+        for field, value in record.items():
+            columns[field][row] = value
+    return columns
@@ -0,0 +1,90 @@
+# tests/test_sms_parser.py
+"""Parity of sms_parser with the original regex parser, on randomized messages."""
+import random
+
+import pytest
+
+from benchmarks.bench_parser import legacy_parse
+from sms_parser import INT64_MAX, PARSE_FAILURE_REASONS, failure_reason, parse_batch, parse_sms
+
+CASES = 20000
+BATCH_FIELDS = ("MID", "battery_vol", "network", "WH", "status_code")
+
+
+def random_message(rng):
+    """Random text from an alphabet chosen to hit the pattern's edge cases.
+
+    Whitespace, tabs and newlines, commas, "_", non-ASCII digits, and numbers around
+    the int64 limit and beyond int()'s digit limit.
+    """
+    alphabet = ["#S", "#", "S", "@", ",", ",", ",", " ", "\t", "\n", "_", "a", "M1", "7", "42", "٣", "²", "x"]
+    if rng.random() < 0.5:
+        # Near-valid: a valid message with a few random insertions
+        fields = ["#S", f"M{rng.randint(0, 99)}", "@", str(rng.randint(0, 5000)), str(rng.randint(0, 40)),
+                  str(rng.randint(0, 10 ** 9))]
+        if rng.random() < 0.02:
+            fields[rng.choice((3, 4, 5))] = rng.choice((str(INT64_MAX), str(INT64_MAX + 1), "1" + "0" * 18,
+                                                        "9" * 25, "9" * 5000))
+        message = ",".join(fields)
+        for _ in range(rng.randint(0, 3)):
+            position = rng.randint(0, len(message))
+            message = message[:position] + rng.choice(alphabet) + message[position:]
+        return message
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+
+
+def expected_parse(message):
+    """The original parser's result, except numbers beyond int64: it accepted them, but MongoDB
+    could not store them, so they are now rejected as "out_of_range"."""
+    expected = legacy_parse(message)
+    if expected is not None and max(expected["battery_vol"], expected["network"], expected["WH"]) > INT64_MAX:
+        return None, "out_of_range"
+    return expected, None
+
+
+def batch_row(columns, row):
+    if not columns["valid"][row]:
+        return None
+    return {field: (columns[field][row].item() if hasattr(columns[field][row], "item") else columns[field][row])
+            for field in BATCH_FIELDS}
+
+
+@pytest.fixture(scope="module", params=[1, 2, 3])
+def messages(request):
+    rng = random.Random(request.param)
+    return [random_message(rng) for _ in range(CASES)]
+
+
+def test_parse_sms_matches_original_parser(messages):
+    for message in messages:
+        assert parse_sms(message) == expected_parse(message)[0], message
+
+
+def test_parse_batch_matches_original_parser(messages):
+    columns = parse_batch(messages)
+    for row, message in enumerate(messages):
+        expected, reason = expected_parse(message)
+        assert batch_row(columns, row) == expected, message
+        if expected is None:
+            assert columns["reason"][row] == failure_reason(message), message
+            assert columns["reason"][row] in PARSE_FAILURE_REASONS, message
+        if reason is not None:
+            assert columns["reason"][row] == reason, message
+
+
+@pytest.mark.parametrize("message, valid, reason", [
+    (f"#S,M1,@,3600,20,{INT64_MAX}", True, None),
+    (f"#S,M1,@,3600,20,{INT64_MAX + 1}", False, "out_of_range"),
+    (f" #S , M1 ,@, 3600,20 ,000{INT64_MAX + 1}", False, "out_of_range"),
+    (f"#S,M1,@,{INT64_MAX + 1},20,5", False, "out_of_range"),
+    ("#S,M1,@,3600,20," + "9" * 5000, False, "out_of_range"),
+    ("#S,M1,@,3600,n/a,5", False, "non_numeric"),
+    ("#S,M1,@,3600,20", False, "field_count"),
+])
+def test_int64_limit(message, valid, reason):
+    assert (parse_sms(message) is not None) == valid
+    columns = parse_batch([message])
+    assert bool(columns["valid"][0]) == valid
+    assert columns["reason"][0] == reason
+    if not valid:
+        assert failure_reason(message) == reason